@@ -7,3 +7,5 @@ from . import instances
 from . import plugins
 from . import contexts
 from . import apps
+from . import drift
+from . import dependents
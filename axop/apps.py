@@ -19,15 +19,18 @@ Manages App Kind
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
+import asyncio
 import base64
+from typing import Optional
 import kopf
 import kubernetes
-import yaml
-from . import settings
+from . import metrics, settings
 from .typing.apps import AppKind
 from .axon.axonserver import AxonServer
-from .instances import instance_from_index
+from .instances import wait_instance
+from .kube import kube
 from .utils.checks import admission_error_immutable
+from .utils.deadline import handler_deadline
 
 APPS='apps'
 
@@ -35,32 +38,112 @@ def base64encode(value: str) -> str:
     """Encode string in base64"""
     return base64.b64encode(value.encode(encoding='UTF-8')).decode(encoding='UTF-8')
 
+def base64decode(value: str) -> str:
+    """Decode string in base64"""
+    return base64.b64decode(value.encode(encoding='UTF-8')).decode(encoding='UTF-8')
+
+def binding(kapp: AppKind, grpc: str, token: Optional[str]) -> dict:
+    """
+    Binding secret (token and grpc url) owned by the application
+
+    Without token, only the url is set.
+    """
+    data = {
+        "apiVersion": "v1",
+        "kind": "Secret",
+        "metadata": {
+            "name": kapp.metadata.name
+        },
+        "type": "Opaque",
+        "data": {
+            "url": base64encode(grpc)
+        }
+    }
+    if token:
+        data["data"]["token"] = base64encode(token)
+
+    # Cascade deletion (owner from the App object: same fields on every apply)
+    kopf.adopt(data, owner=kapp.dict(exclude_none=True))
+
+    return data
+
+def binding_token(kapp: AppKind) -> Optional[str]:
+    """
+    Token of the existing binding secret (None if there is none)
+    """
+    try:
+        secret = kube.core_v1.read_namespaced_secret(kapp.metadata.name, kapp.metadata.namespace)
+    except kubernetes.client.ApiException as e:
+        if e.status == 404:
+            return None
+        raise
+
+    token = (secret.data or {}).get("token")
+    return base64decode(token) if token else None
+
+def apply_binding(kapp: AppKind, grpc: str, token: str) -> bool:
+    """
+    Create or update the binding secret in the application namespace
+
+    Server-side apply: one idempotent request whether the secret exists or not.
+
+    Axon Server only returns a token when the application is registered: an
+    application already registered (eg: retry) keeps the token of the existing
+    secret. Return False if there is no token to write (only the url is set).
+    """
+    if not token:
+        # applied fields are owned: a token left out would be removed
+        token = binding_token(kapp)
+
+    kube.core_v1.patch_namespaced_secret(
+        kapp.metadata.name,
+        kapp.metadata.namespace,
+        binding(kapp, grpc, token),
+        field_manager=settings.OPERATOR,
+        force=True,
+        _content_type="application/apply-patch+yaml"
+    )
+
+    return bool(token)
+
+def update_binding_url(kapp: AppKind, grpc: str) -> bool:
+    """
+    Update the grpc url of the binding secret (False if the secret does not exist yet)
+    """
+    try:
+        kube.core_v1.patch_namespaced_secret(
+            kapp.metadata.name,
+            kapp.metadata.namespace,
+            {"data": {"url": base64encode(grpc)}}
+        )
+    except kubernetes.client.ApiException as e:
+        if e.status == 404:
+            # not registered yet: created with the current url
+            return False
+        raise
+
+    return True
+
 @kopf.on.create(settings.GROUP, settings.LATEST_VERSION, APPS, timeout=settings.DEFAULT_TIMEOUT)
-def app_register(instances_idx: kopf.Index, body: kopf.Body, patch: kopf.Patch, **_):
+@metrics.observe_handler(APPS)
+@handler_deadline(settings.DEFAULT_TIMEOUT)
+async def app_register(instances_idx: kopf.Index, body: kopf.Body, patch: kopf.Patch, **_):
     """
     Register an application with contexts permissions
     """
     patch.status[settings.STATUS_SUCCESS] = False
 
     kapp: AppKind = AppKind.parse_obj(body)
-    axon_instance = instance_from_index(instances_idx, kapp.spec.instance)
+    axon_instance = await wait_instance(instances_idx, kapp.spec.instance)
 
-    with AxonServer(axon_instance) as axon:
-        token = axon.update_application(body.meta["uid"], kapp.spec)
+    async with AxonServer(axon_instance) as axon:
+        token = await axon.update_application(body.meta["uid"], kapp.spec)
 
     # Create binding secret on the right namespace
-    with kubernetes.client.ApiClient() as api_client:
-        api: kubernetes.client.CoreV1Api = kubernetes.client.CoreV1Api(api_client)
-        content = settings.BINDING.format(
-            name=kapp.metadata.name,
-            grpc=base64encode(axon_instance.grpc),
-            token=base64encode(token)
+    if not await asyncio.to_thread(apply_binding, kapp, axon_instance.grpc, token):
+        raise kopf.PermanentError(
+            "application already registered without its token: recreate the App object"
         )
-        data = yaml.safe_load(content)
-
-        kopf.adopt(data) # Cascade deletion
-
-        api.create_namespaced_secret(kapp.metadata.namespace, data)
 
     # Status
     patch.status[settings.STATUS_SUCCESS] = True
@@ -68,7 +151,9 @@ def app_register(instances_idx: kopf.Index, body: kopf.Body, patch: kopf.Patch,
     return {"secretName": kapp.metadata.name}
 
 @kopf.on.update(settings.GROUP, settings.LATEST_VERSION, APPS, timeout=settings.DEFAULT_TIMEOUT)
-def app_update(instances_idx: kopf.Index, body: kopf.Body, patch: kopf.Patch, **_):
+@metrics.observe_handler(APPS)
+@handler_deadline(settings.DEFAULT_TIMEOUT)
+async def app_update(instances_idx: kopf.Index, body: kopf.Body, patch: kopf.Patch, **_):
     """
     Update an application (permissions)
 
@@ -77,51 +162,54 @@ def app_update(instances_idx: kopf.Index, body: kopf.Body, patch: kopf.Patch, **
     patch.status[settings.STATUS_SUCCESS] = False
 
     kapp: AppKind = AppKind.parse_obj(body)
-    axon_instance = instance_from_index(instances_idx, kapp.spec.instance)
+    axon_instance = await wait_instance(instances_idx, kapp.spec.instance)
 
-    with AxonServer(axon_instance) as axon:
-        axon.update_application(body.meta["uid"], kapp.spec)
+    async with AxonServer(axon_instance) as axon:
+        await axon.update_application(body.meta["uid"], kapp.spec)
 
     patch.status[settings.STATUS_SUCCESS] = True
 
 @kopf.on.delete(settings.GROUP, settings.LATEST_VERSION, APPS, timeout=settings.DEFAULT_TIMEOUT)
-def app_unregister(instances_idx: kopf.Index, body: kopf.Body, **_):
+@metrics.observe_handler(APPS)
+@handler_deadline(settings.DEFAULT_TIMEOUT)
+async def app_unregister(instances_idx: kopf.Index, body: kopf.Body, **_):
     """
     Unregister an application
     """
     kapp: AppKind = AppKind.parse_obj(body)
-    axon_instance = instance_from_index(instances_idx, kapp.spec.instance)
+    axon_instance = await wait_instance(instances_idx, kapp.spec.instance)
 
-    with AxonServer(axon_instance) as axon:
-        axon.unregister_application(body.meta["uid"])
+    async with AxonServer(axon_instance) as axon:
+        await axon.unregister_application(body.meta["uid"])
+
+@kopf.index(settings.GROUP, settings.LATEST_VERSION, APPS)
+def apps_idx(body: kopf.Body, **_):
+    """
+    Index all applications per instance
+    """
+    kapp: AppKind = AppKind.parse_obj(body)
+
+    return {
+        kapp.spec.instance: kapp
+    }
 
 @kopf.on.validate(settings.GROUP, settings.LATEST_VERSION, APPS)
-def appadmission(body: kopf.Body, **_):
+async def appadmission(body: kopf.Body, old: Optional[kopf.Body], **_):
     """
     App Admission
 
     instance and description are immutables
     """
-    if body.meta["generation"] == 1:
-        return
+    with metrics.ADMISSION_DURATION.labels(APPS).time():
+        if old is None:
+            return
 
-    # previous version already exist. Checking immutable fields
-
-    knew: AppKind = AppKind.parse_obj(body)
-
-    with kubernetes.client.ApiClient() as api_client:
-        api: kubernetes.client.CustomObjectsApi = kubernetes.client.CustomObjectsApi(api_client)
-        response = api.get_namespaced_custom_object(
-            settings.GROUP,
-            settings.LATEST_VERSION,
-            knew.metadata.namespace,
-            APPS,
-            knew.metadata.name
-        )
+        # previous version already exist (provided by the admission request).
+        # Checking immutable fields
 
-    kcurrent: AppKind = AppKind.parse_obj(response)
+        knew: AppKind = AppKind.parse_obj(body)
 
-    if kcurrent.spec.description != knew.spec.description:
-        raise admission_error_immutable(".spec.description")
-    if kcurrent.spec.instance != knew.spec.instance:
-        raise admission_error_immutable(".spec.instance")
+        if old.spec.get("description") != knew.spec.description:
+            raise admission_error_immutable(".spec.description")
+        if old.spec.get("instance") != knew.spec.instance:
+            raise admission_error_immutable(".spec.instance")
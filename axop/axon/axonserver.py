@@ -19,19 +19,39 @@ AxonIQ Server EE
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import List
-import requests
+import asyncio
+import json
+import random
+import time
+from typing import List, Optional, Tuple
+import aiohttp
+from .breaker import breakers
 from .errors import ErrAxonServerNetwork
+from .limiter import limiters
+from .pool import sessions
+from .singleflight import SingleFlight
+from .. import metrics, settings
+from ..utils import deadline
+from ..utils.fingerprint import fingerprint
 from ..instances import InternalInstance
 from ..typing.contexts import ContextSpec
 from ..typing.apps import AppSpec
 
 class AxonServer():
-    """AxonIQ Server EE"""
+    """AxonIQ Server EE
+
+    Asynchronous client (aiohttp) to use as an async context manager.
+    Connections are kept alive between handlers in a pool per instance.
+    """
+
+    TRANSIENT_STATUS = (429, 502, 503, 504)
+
+    # identical requests in flight (all instances)
+    flights = SingleFlight()
 
     def __init__(self, instance: InternalInstance):
         self._instance = instance
-        self._session = None
+        self._session: Optional[aiohttp.ClientSession] = None
 
     @property
     def url(self) -> str:
@@ -39,36 +59,158 @@ class AxonServer():
         return self._instance.http
 
     @property
-    def headers(self) -> dict:
-        """Axon Server API headers"""
-        return {
-            "AxonIQ-Access-Token": self._instance.get_axon_token()
-        }
-
-    @property
-    def session(self) -> requests.Session:
+    def session(self) -> aiohttp.ClientSession:
         """Network session with Axon Server"""
         return self._session
 
-    def __enter__(self):
-        self._session = requests.session()
-        self._session.headers.update(self.headers)
+    async def __aenter__(self):
+        self._session = await sessions.session(self._instance)
         return self
 
-    def __exit__(self, type, value, traceback): # pylint: disable=redefined-builtin
-        self._session.close()
+    async def __aexit__(self, type, value, traceback): # pylint: disable=redefined-builtin
+        # the session is owned by the pool
+        sessions.release(self._session)
         self._session = None
 
     @classmethod
-    def _check(cls, response: requests.Response, status_accepted: List[int]):
-        if response.status_code not in status_accepted:
-            raise ErrAxonServerNetwork(response.status_code, response.text)
+    def _check(cls, status: int, text: str, status_accepted: List[int]):
+        if status not in status_accepted:
+            raise ErrAxonServerNetwork(status, text)
+
+    async def _send(self, session: aiohttp.ClientSession, method: str, path: str, endpoint: str, # pylint: disable=too-many-arguments
+        **kwargs) -> Tuple[int, str]:
+        """Send one request to Axon Server and return the status code and the body"""
+        limiter = limiters.get(self._instance.name)
+
+        try:
+            await asyncio.wait_for(limiter.acquire(), timeout=deadline.remaining())
+        except asyncio.TimeoutError as e:
+            raise deadline.DeadlineExceeded("Deadline exceeded") from e
+
+        labels = (self._instance.name, method, endpoint)
+
+        started = time.monotonic()
+        try:
+            # the slot is released whatever happens (deadline exceeded included)
+            total = deadline.timeout(
+                settings.AXON_READ_TIMEOUT if method == "GET" else settings.AXON_WRITE_TIMEOUT
+            )
+            client_timeout = aiohttp.ClientTimeout(
+                total=total,
+                sock_connect=min(settings.AXON_CONNECT_TIMEOUT, total)
+            )
+
+            async with session.request(method, f"{self.url}{path}",
+                timeout=client_timeout, **kwargs) as response:
+                text = await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            latency = time.monotonic() - started
+            limiter.release(None, latency)
+            metrics.AXON_REQUEST_DURATION.labels(*labels).observe(latency)
+            metrics.AXON_RESPONSES.labels(*labels, "error").inc()
+            raise
+        except BaseException:
+            limiter.discard()
+            raise
+
+        latency = time.monotonic() - started
+        limiter.release(response.status, latency)
+        metrics.AXON_REQUEST_DURATION.labels(*labels).observe(latency)
+        metrics.AXON_RESPONSES.labels(*labels, str(response.status)).inc()
+
+        return response.status, text
+
+    async def _request(self, method: str, path: str, idempotent: bool = True, # pylint: disable=too-many-arguments
+        endpoint: Optional[str] = None, **kwargs) -> Tuple[int, str]:
+        """
+        Send a request to Axon Server and return the status code and the body
+
+        Identical requests in flight (same instance, method, url, parameters and
+        payload) share one call and its result, eg: the same context declared by
+        multiple objects.
+
+        endpoint is the path without variable parts (metrics), path by default.
+        """
+        key = (
+            self._instance.name, method, f"{self.url}{path}",
+            fingerprint(kwargs.get("params"), kwargs.get("json"))
+        )
+
+        if key in AxonServer.flights:
+            metrics.AXON_DEDUPLICATED.labels(self._instance.name).inc()
 
-    def update_context(self, context: ContextSpec):
+        # the session is captured: the call can outlive the caller (shared)
+        session = self.session
+
+        return await AxonServer.flights.do(
+            key, lambda: self._call(session, method, path, idempotent, endpoint or path, **kwargs)
+        )
+
+    async def _call(self, session: aiohttp.ClientSession, method: str, path: str, # pylint: disable=too-many-arguments
+        idempotent: bool, endpoint: str, **kwargs) -> Tuple[int, str]:
+        """
+        Send a request to Axon Server (with retries)
+
+        Transient errors are retried with an exponential backoff. A request that is
+        not idempotent is retried only when Axon Server did not process it. The
+        probe of an unavailable instance is sent once (see CircuitBreaker.check).
+        """
+        # the session stays open until the call ends (shared calls outlive callers)
+        sessions.borrow(session)
+        try:
+            return await self._attempts(session, method, path, idempotent, endpoint, **kwargs)
+        finally:
+            sessions.release(session)
+
+    async def _attempts(self, session: aiohttp.ClientSession, method: str, path: str, # pylint: disable=too-many-arguments
+        idempotent: bool, endpoint: str, **kwargs) -> Tuple[int, str]:
+        """Attempts of a request (see _call)"""
+        breaker = breakers.get(self._instance.name)
+        attempt = 0
+
+        while True:
+            probe = breaker.check()
+
+            try:
+                status, text = await self._send(session, method, path, endpoint, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+                retriable = idempotent or isinstance(e, aiohttp.ClientConnectorError)
+            except BaseException:
+                # deadline or cancellation: a probe without answer reopens the breaker
+                if probe:
+                    breaker.failure()
+                raise
+            else:
+                if status not in AxonServer.TRANSIENT_STATUS:
+                    breaker.success()
+                    return status, text
+
+                error = None
+                retriable = idempotent or status in (429, 503)
+
+            # a probe is not retried: the instance is still unavailable
+            if not retriable or probe or attempt >= settings.AXON_RETRIES:
+                breaker.failure()
+                if error is not None:
+                    raise error
+                return status, text
+
+            attempt += 1
+            metrics.AXON_RETRIES.labels(self._instance.name).inc()
+
+            # exponential backoff with full jitter
+            await asyncio.sleep(deadline.timeout(random.uniform(0, min(
+                settings.AXON_RETRY_BACKOFF_MAX,
+                settings.AXON_RETRY_BACKOFF * 2 ** attempt
+            ))))
+
+    async def update_context(self, context: ContextSpec):
         """Create/update multiple contexts"""
 
-        response = self.session.post(
-            f"{self.url}/v1/context",
+        status, text = await self._request(
+            "POST",
+            "/v1/context",
             json = {
                 "context": context.context,
                 "replicationGroup": context.replicationGroup
@@ -77,48 +219,48 @@ class AxonServer():
 
         # since 4.5.11, post with an existing context will result in:
         # code: 400 - message: [AXONIQ-1304] Context already exists
-        if response.status_code == 400 and "[AXONIQ-1304]" in response.text:
+        if status == 400 and "[AXONIQ-1304]" in text:
             return
 
-        self._check(response, [200, 202])
+        self._check(status, text, [200, 202])
 
-    def update_context_plugin(self, payload: dict):
+    async def update_context_plugin(self, payload: dict):
         """Update plugin configuration"""
 
-        response = self.session.post(f"{self.url}/v1/plugins/configuration", json=payload)
-        self._check(response, [200, 201])
+        status, text = await self._request("POST", "/v1/plugins/configuration", json=payload)
+        self._check(status, text, [200, 201])
 
-    def update_context_plugin_status(self, payload: dict, active: bool=True):
+    async def update_context_plugin_status(self, payload: dict, active: bool=True):
         """Enable/Disable a plugin"""
 
-        name = payload["name"]
-        context = payload["context"]
-        version = payload["version"]
-
-        response = self.session.post(
-            f"{self.url}/v1/plugins/status?active={active}" \
-            f"&name={name}" \
-            f"&targetContext={context}" \
-            f"&version={version}"
+        status, text = await self._request(
+            "POST",
+            "/v1/plugins/status",
+            params = {
+                "active": str(active),
+                "name": payload["name"],
+                "targetContext": payload["context"],
+                "version": payload["version"]
+            }
         )
-        self._check(response, [200, 201])
+        self._check(status, text, [200, 201])
 
-    def remove_context_plugin(self, payload: dict):
+    async def remove_context_plugin(self, payload: dict):
         """Remove plugin configuration for the context"""
 
-        name = payload["name"]
-        context = payload["context"]
-        version = payload["version"]
-
-        response = self.session.delete(
-            f"{self.url}/v1/plugins/context?" \
-            f"name={name}" \
-            f"&targetContext={context}" \
-            f"&version={version}"
+        status, text = await self._request(
+            "DELETE",
+            "/v1/plugins/context",
+            params = {
+                "name": payload["name"],
+                "targetContext": payload["context"],
+                "version": payload["version"]
+            }
         )
-        self._check(response, [200, 204])
+        # already removed (eg: retry)
+        self._check(status, text, [200, 204, 404])
 
-    def update_application(self, uid: str, app: AppSpec) -> str:
+    async def update_application(self, uid: str, app: AppSpec) -> str:
         """Register/Update an application with contexts roles"""
 
         payload = {
@@ -127,13 +269,42 @@ class AxonServer():
             "roles": [i.dict() for i in app.contexts]
         }
 
-        response = self.session.post(f"{self.url}/v1/applications", json=payload)
-        self._check(response, [200])
+        # a new application generates a token so this request is not idempotent
+        status, text = await self._request(
+            "POST", "/v1/applications", idempotent=False, json=payload
+        )
+        self._check(status, text, [200])
 
-        return response.text
+        return text
 
-    def unregister_application(self, uid: str):
+    async def unregister_application(self, uid: str):
         """Unregister an application"""
 
-        response = self.session.delete(f"{self.url}/v1/applications/{uid}")
-        self._check(response, [200, 404])
+        status, text = await self._request(
+            "DELETE", f"/v1/applications/{uid}", endpoint="/v1/applications/{name}"
+        )
+        self._check(status, text, [200, 404])
+
+    async def get_contexts(self) -> List[dict]:
+        """List contexts"""
+
+        status, text = await self._request("GET", "/v1/public/context")
+        self._check(status, text, [200])
+
+        return json.loads(text)
+
+    async def get_applications(self) -> List[dict]:
+        """List applications with their contexts roles"""
+
+        status, text = await self._request("GET", "/v1/applications")
+        self._check(status, text, [200])
+
+        return json.loads(text)
+
+    async def get_plugins(self) -> List[dict]:
+        """List plugins with their status per context"""
+
+        status, text = await self._request("GET", "/v1/plugins")
+        self._check(status, text, [200])
+
+        return json.loads(text)
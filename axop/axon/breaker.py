@@ -0,0 +1,107 @@
+"""
+Circuit breaker per Axon Server instance
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import time
+from typing import Dict
+from .errors import ErrAxonServerUnavailable
+from .. import metrics, settings
+
+breaker_logger = logging.getLogger("axop.axon.breaker")
+
+class CircuitBreaker():
+    """
+    Circuit breaker for one instance
+
+    closed: requests are sent
+    open: requests fail fast during AXON_BREAKER_COOLDOWN
+    half-open: one request is sent to probe the instance
+    """
+
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+    def __init__(self, name: str):
+        self._name = name
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+
+        metrics.AXON_BREAKER_STATE.labels(self._name).set(self._state)
+
+    def check(self) -> bool:
+        """
+        Raise ErrAxonServerUnavailable if requests are not allowed
+
+        Return True if the request is the probe: it must end with success() or
+        failure() whatever happens, the breaker stays half-open until then.
+        """
+        if self._state == CircuitBreaker.CLOSED:
+            return False
+
+        remaining = self._opened_at + settings.AXON_BREAKER_COOLDOWN - time.monotonic()
+
+        if self._state == CircuitBreaker.OPEN and remaining <= 0:
+            # this request is the probe
+            self._set_state(CircuitBreaker.HALF_OPEN)
+            return True
+
+        raise ErrAxonServerUnavailable(self._name, max(1.0, remaining))
+
+    def success(self):
+        """Instance answered"""
+        self._failures = 0
+        if self._state != CircuitBreaker.CLOSED:
+            breaker_logger.info("Instance %s is available", self._name)
+            self._set_state(CircuitBreaker.CLOSED)
+
+    def failure(self):
+        """Instance did not answer (retries exhausted)"""
+        self._failures += 1
+
+        if self._state == CircuitBreaker.HALF_OPEN or \
+            self._failures >= settings.AXON_BREAKER_THRESHOLD:
+            if self._state != CircuitBreaker.OPEN:
+                breaker_logger.warning("Instance %s is unavailable", self._name)
+            self._opened_at = time.monotonic()
+            self._set_state(CircuitBreaker.OPEN)
+
+    def _set_state(self, state: int):
+        self._state = state
+        metrics.AXON_BREAKER_STATE.labels(self._name).set(state)
+
+class CircuitBreakers(): # pylint: disable=too-few-public-methods
+    """Circuit breakers per instance name"""
+
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+
+    def get(self, name: str) -> CircuitBreaker:
+        """Get the circuit breaker of an instance"""
+        breaker = self._breakers.get(name)
+        if breaker is None:
+            breaker = CircuitBreaker(name)
+            self._breakers[name] = breaker
+
+        return breaker
+
+breakers = CircuitBreakers()
@@ -19,6 +19,8 @@ Exceptions class for Axon Server
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
+import kopf
+
 class AxonBrokerException(Exception):
     """Generic Axon Exception"""
 
@@ -27,3 +29,10 @@ class ErrAxonServerNetwork(AxonBrokerException):
     def __init__(self, status_code: int, msg: str):
         AxonBrokerException.__init__(self,
             f"Network error occured. status_code={status_code}, msg={msg}")
+
+class ErrAxonServerUnavailable(AxonBrokerException, kopf.TemporaryError):
+    """Circuit breaker open (handler will be retried after the delay)"""
+    def __init__(self, name: str, delay: float):
+        AxonBrokerException.__init__(self)
+        kopf.TemporaryError.__init__(self,
+            f"Axon Server instance {name} is unavailable", delay=delay)
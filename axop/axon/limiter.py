@@ -0,0 +1,178 @@
+"""
+Adaptive rate limiter and concurrency controller for Axon Server
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import time
+from typing import Deque, Dict, Optional
+from .. import metrics, settings
+
+class AdaptiveLimiter(): # pylint: disable=too-many-instance-attributes
+    """
+    Token bucket (requests per second) and AIMD concurrency for one instance
+
+    Limits are multiplicatively decreased when Axon Server sheds load (429/503,
+    network errors) or when a response is slower than AXON_LATENCY_TARGET and
+    additively increased while it is healthy.
+    """
+
+    # multiplicative decrease (at most once per cooldown)
+    OVERLOAD_FACTOR = 0.5
+    SLOW_FACTOR = 0.8
+    DECREASE_COOLDOWN = 1.0
+
+    def __init__(self, name: str):
+        self._name = name
+
+        self._max_rate = float(settings.AXON_RATE_LIMIT)
+        self._rate = self._max_rate / 2
+        self._tokens = 1.0
+        self._updated = time.monotonic()
+
+        self._max_concurrency = float(settings.AXON_CONCURRENCY_LIMIT)
+        self._concurrency = max(1.0, self._max_concurrency / 2)
+        self._in_flight = 0
+        self._waiters: Deque[asyncio.Future] = collections.deque()
+        self._decreased = 0.0
+
+        self._publish()
+
+    @property
+    def rate(self) -> float:
+        """Current requests per second allowed"""
+        return self._rate
+
+    @property
+    def concurrency(self) -> int:
+        """Current concurrent requests allowed"""
+        return int(self._concurrency)
+
+    async def acquire(self):
+        """Wait for a concurrency slot and a token"""
+        await self._acquire_slot()
+
+        try:
+            await self._take_token()
+        except BaseException:
+            self._release_slot()
+            raise
+
+    def release(self, status: Optional[int], latency: float):
+        """
+        Release the slot and adapt limits with the response (status None on network error)
+        """
+        if status is None or status in (429, 503):
+            self._decrease(AdaptiveLimiter.OVERLOAD_FACTOR)
+        elif latency > settings.AXON_LATENCY_TARGET:
+            self._decrease(AdaptiveLimiter.SLOW_FACTOR)
+        else:
+            self._increase()
+
+        self._release_slot()
+
+    def discard(self):
+        """Release the slot without adapting limits (eg: request cancelled)"""
+        self._release_slot()
+
+    def _decrease(self, factor: float):
+        now = time.monotonic()
+        if now - self._decreased < AdaptiveLimiter.DECREASE_COOLDOWN:
+            # responses of the same burst
+            return
+
+        self._decreased = now
+        self._concurrency = max(1.0, self._concurrency * factor)
+        self._rate = max(1.0, self._rate * factor)
+
+    def _increase(self):
+        self._concurrency = min(self._max_concurrency, self._concurrency + 1 / self._concurrency)
+        self._rate = min(self._max_rate, self._rate + 1)
+
+    async def _acquire_slot(self):
+        if self._in_flight < self.concurrency and len(self._waiters) == 0:
+            self._in_flight += 1
+            self._publish()
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._publish()
+
+        try:
+            # the slot is counted by _wake
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self._release_slot()
+            else:
+                self._waiters.remove(waiter)
+                self._publish()
+            raise
+
+    def _release_slot(self):
+        self._in_flight -= 1
+        self._wake()
+        self._publish()
+
+    def _wake(self):
+        while len(self._waiters) > 0 and self._in_flight < self.concurrency:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self._in_flight += 1
+                waiter.set_result(None)
+
+    async def _take_token(self):
+        while True:
+            now = time.monotonic()
+            self._tokens = min(
+                float(settings.AXON_RATE_BURST),
+                self._tokens + (now - self._updated) * self._rate
+            )
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+
+            await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def _publish(self):
+        metrics.AXON_CONCURRENCY_LIMIT.labels(self._name).set(self.concurrency)
+        metrics.AXON_RATE_LIMIT.labels(self._name).set(self._rate)
+        metrics.AXON_IN_FLIGHT.labels(self._name).set(self._in_flight)
+        metrics.AXON_QUEUE_DEPTH.labels(self._name).set(len(self._waiters))
+
+class AdaptiveLimiters(): # pylint: disable=too-few-public-methods
+    """Limiters per instance name"""
+
+    def __init__(self):
+        self._limiters: Dict[str, AdaptiveLimiter] = {}
+
+    def get(self, name: str) -> AdaptiveLimiter:
+        """Get the limiter of an instance"""
+        limiter = self._limiters.get(name)
+        if limiter is None:
+            limiter = AdaptiveLimiter(name)
+            self._limiters[name] = limiter
+
+        return limiter
+
+limiters = AdaptiveLimiters()
@@ -0,0 +1,154 @@
+"""
+Long-lived HTTP connection pools for Axon Server
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Set, Tuple
+import aiohttp
+from .. import settings
+from ..instances import InternalInstance
+
+pool_logger = logging.getLogger("axop.axon.pool")
+
+class _PoolEntry(): # pylint: disable=too-few-public-methods
+    """One session and the instance configuration used to build it"""
+    def __init__(self, key: Tuple[str, str], session: aiohttp.ClientSession):
+        self.key = key
+        self.session = session
+        self.last_used = time.monotonic()
+        # handlers and requests using the session
+        self.borrowers = 0
+        # replaced or evicted: closed once it is not borrowed anymore
+        self.retired = False
+
+class AxonSessions():
+    """
+    Long-lived aiohttp sessions (keep-alive) shared by all handlers
+
+    There is one session per instance name. A session is rebuilt only when
+    the instance http endpoint or token changes and is closed when it stays
+    unused longer than AXON_POOL_IDLE_TIMEOUT.
+
+    Sessions are borrowed (session) and given back (release): a borrowed
+    session is never closed, a retired one is closed when its last borrower
+    releases it.
+    """
+
+    def __init__(self):
+        self._entries: Dict[str, _PoolEntry] = {}
+        # all open sessions (retired ones included)
+        self._sessions: Dict[aiohttp.ClientSession, _PoolEntry] = {}
+        self._closing: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    async def session(self, instance: InternalInstance) -> aiohttp.ClientSession:
+        """Borrow the session of an instance (create or rebuild it if needed)"""
+
+        # token lookup can reach the vault (blocking)
+        token = await asyncio.to_thread(instance.get_axon_token)
+        key = (instance.http, token)
+
+        self._evict_idle()
+
+        entry: Optional[_PoolEntry] = self._entries.get(instance.name)
+        if entry is not None and entry.key == key and not entry.session.closed:
+            self.borrow(entry.session)
+            return entry.session
+
+        if entry is not None:
+            pool_logger.info("Rebuilding session for instance %s", instance.name)
+            self._retire(entry)
+
+        session = aiohttp.ClientSession(
+            headers = {
+                "AxonIQ-Access-Token": token
+            },
+            connector = aiohttp.TCPConnector(
+                limit = settings.AXON_POOL_SIZE,
+                keepalive_timeout = settings.AXON_POOL_KEEPALIVE
+            )
+        )
+        entry = _PoolEntry(key, session)
+        self._entries[instance.name] = entry
+        self._sessions[session] = entry
+        self.borrow(session)
+
+        return session
+
+    def borrow(self, session: aiohttp.ClientSession):
+        """Session used by one more handler or request"""
+        entry = self._sessions.get(session)
+        if entry is not None:
+            entry.borrowers += 1
+            entry.last_used = time.monotonic()
+
+    def release(self, session: aiohttp.ClientSession):
+        """Session not used anymore by a handler or request"""
+        entry = self._sessions.get(session)
+        if entry is None:
+            return
+
+        entry.borrowers -= 1
+        entry.last_used = time.monotonic()
+
+        if entry.retired and entry.borrowers <= 0:
+            self._close(entry)
+
+    def _evict_idle(self):
+        """Close sessions not borrowed nor used since AXON_POOL_IDLE_TIMEOUT"""
+        deadline = time.monotonic() - settings.AXON_POOL_IDLE_TIMEOUT
+
+        for name in [
+            name for name, entry in self._entries.items()
+            if entry.borrowers <= 0 and entry.last_used < deadline
+        ]:
+            pool_logger.debug("Evicting idle session for instance %s", name)
+            self._retire(self._entries.pop(name))
+
+    def _retire(self, entry: _PoolEntry):
+        """Close a session now or when its last borrower releases it"""
+        entry.retired = True
+
+        if entry.borrowers <= 0:
+            self._close(entry)
+
+    def _close(self, entry: _PoolEntry):
+        self._sessions.pop(entry.session, None)
+
+        task = asyncio.create_task(entry.session.close())
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    async def close(self):
+        """Close all sessions"""
+        entries = list(self._sessions.values())
+        self._entries.clear()
+        self._sessions.clear()
+
+        for entry in entries:
+            await entry.session.close()
+
+        await asyncio.gather(*self._closing, return_exceptions=True)
+
+sessions = AxonSessions()
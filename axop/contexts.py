@@ -19,48 +19,265 @@ Manages Contexts Kind
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import List
+import asyncio
+import copy
+import logging
+import time
+from typing import Awaitable, Dict, Iterable, List, Optional
 import kopf
-import kubernetes
-from . import settings
+from . import metrics, settings
 from .typing.contexts import ContextsKind, ContextsSpec, ContextSpec
 from .axon.axonserver import AxonServer
-from .instances import instance_from_index
-from .plugins import plugin_from_index
+from .instances import wait_instance
+from .kube import kube
+from .plugins import REASON_REMOVED, REASON_VERSION, InternalPlugin, change_reason, wait_plugin
 from .utils.checks import admission_error_immutable
+from .utils.deadline import handler_deadline
+from .utils.concurrency import KeyedSemaphores, gather_bounded
+from .utils.fingerprint import fingerprint
 
 CONTEXTS='contexts'
 
-def __cud_plugin(plugins_idx: kopf.Index, name: str, context: ContextSpec, # pylint: disable=too-many-arguments
-    plugin: dict, axon: AxonServer, delete: bool = False):
+contexts_logger = logging.getLogger("axop.contexts")
+
+contexts_semaphores = KeyedSemaphores(settings.AXON_CONTEXTS_CONCURRENCY)
+
+class AppliedContexts(): # pylint: disable=too-many-instance-attributes
     """
-    Create, update or delete a plugin configuration for a context
+    Fingerprints of contexts and plugins successfully applied on Axon Server
+
+    They are stored in the status to skip identical calls on retries and updates:
+    a retry resumes from the first context or plugin not applied. The result of
+    each context is also reported in the status (progress).
     """
-    plugin_instance = plugin_from_index(plugins_idx, name)
-    payload = plugin_instance.get_payload(context.context, plugin)
 
-    if delete:
-        # axon.update_context_plugin_status(payload, active=False)
-        axon.remove_context_plugin(payload)
-    else:
-        axon.update_context_plugin(payload)
-        axon.update_context_plugin_status(payload, active=True)
+    def __init__(self, body: kopf.Body, patch: kopf.Patch):
+        self._applied: dict = body.status.get(settings.STATUS_APPLIED, {})
+        self._updates: dict = {}
+        self._progress: dict = {}
+        self._changes: dict = {}
+        patch.status[settings.STATUS_APPLIED] = self._updates
+        patch.status[settings.STATUS_PROGRESS] = self._progress
+
+        self._namespace = body.meta.namespace
+        self._name = body.meta.name
+        self._dirty = False
+        self._checkpointed = time.monotonic()
+        self._checkpoint_lock = asyncio.Lock()
+
+    def context(self, context: str) -> Optional[str]:
+        """Fingerprint of the context applied"""
+        return self._get(context).get("context")
+
+    def plugin(self, context: str, name: str) -> Optional[str]:
+        """Fingerprint of the plugin applied on the context"""
+        return (self._get(context).get("plugins") or {}).get(name)
+
+    def set_context(self, context: str, value: str):
+        """Context applied"""
+        self._updates.setdefault(context, {})["context"] = value
+        self._dirty = True
+
+    def set_plugin(self, context: str, name: str, value: Optional[str]):
+        """Plugin applied (or removed if value is None) on the context"""
+        self._updates.setdefault(context, {}).setdefault("plugins", {})[name] = value
+        self._dirty = True
+
+    def set_change(self, context: str, name: str, reason: str):
+        """Plugin configuration applied on the context (reason of the change)"""
+        self._changes.setdefault(context, {})[name] = reason
+
+    def set_result(self, context: str, error: Optional[BaseException]):
+        """Context fully applied (error is None) or failed"""
+        self._progress[context] = {
+            "success": error is None,
+            "error": None if error is None else f"{type(error).__name__}: {error}"[:256],
+            "changes": self._changes.get(context, {})
+        }
+        self._dirty = True
+
+    async def checkpoint(self):
+        """
+        Write the progress to the status while the handler is running
+
+        Changes are batched: at most one patch every CHECKPOINT_INTERVAL. The
+        handler patch (written by kopf at the end) contains the same values.
+        """
+        if settings.CHECKPOINT_INTERVAL <= 0 or self._checkpoint_lock.locked():
+            return
+        if not self._dirty or time.monotonic() - self._checkpointed < settings.CHECKPOINT_INTERVAL:
+            return
+
+        async with self._checkpoint_lock:
+            self._dirty = False
+            self._checkpointed = time.monotonic()
+            status = copy.deepcopy({
+                settings.STATUS_APPLIED: self._updates,
+                settings.STATUS_PROGRESS: self._progress
+            })
+
+            try:
+                await asyncio.to_thread(
+                    kube.custom_objects.patch_namespaced_custom_object,
+                    settings.GROUP, settings.LATEST_VERSION, self._namespace, CONTEXTS, self._name,
+                    {"status": status},
+                    _content_type="application/merge-patch+json"
+                )
+                metrics.HANDLER_CHECKPOINTS.labels(CONTEXTS).inc()
+            except Exception as e: # pylint: disable=broad-except
+                # best effort: the handler patch will be written anyway
+                self._dirty = True
+                contexts_logger.warning("Checkpoint of %s/%s failed: %s",
+                    self._namespace, self._name, e)
+
+    def removed(self, context: str, name: str) -> bool:
+        """Plugin removal already applied (context known and plugin not applied)"""
+        return self.context(context) is not None and self.plugin(context, name) is None
+
+    def _get(self, context: str) -> dict:
+        updates = self._updates.get(context, {})
+        applied = self._applied.get(context) or {}
+
+        return {
+            "context": updates.get("context", applied.get("context")),
+            "plugins": {**(applied.get("plugins") or {}), **updates.get("plugins", {})}
+        }
+
+class PluginChange(): # pylint: disable=too-few-public-methods
+    """
+    A plugin configuration to apply on a context and the reason of the change
+    """
+    def __init__(self, name: str, reason: str, payload: dict, # pylint: disable=too-many-arguments
+        payload_fingerprint: Optional[str] = None, previous: Optional[dict] = None):
+        self.name = name
+        self.reason = reason
+        # rendered payload (or reference of the plugin removed)
+        self.payload = payload
+        self.payload_fingerprint = payload_fingerprint
+        # reference of the previous version to remove
+        self.previous = previous
+
+async def __resolve_plugins(plugins_idx: kopf.Index,
+    specs: Iterable[ContextSpec]) -> Dict[str, InternalPlugin]:
+    """
+    Plugin objects used by the contexts
 
-def __cu_contexts(contexts: List[ContextSpec], axon: AxonServer, plugins_idx: kopf.Index):
+    Missing plugins are waited for before a slot of the instance is taken: a
+    Context object referencing them does not stall the other ones.
     """
-    Create or update contexts
+    names = sorted({name for context in specs for name in (context.plugins or {})})
+
+    return dict(zip(names, await asyncio.gather(*[wait_plugin(plugins_idx, i) for i in names])))
+
+async def __diff_plugins(context: ContextSpec, previous: Optional[dict],
+    plugins: Dict[str, InternalPlugin], applied: AppliedContexts) -> List[PluginChange]:
+    """
+    Plugins of a context whose rendered payload differs from the one applied
+
+    Payloads are compared with their fingerprints (secrets versions included): a
+    change in the object without effect on the payload is not applied and a secret
+    rotation is.
     """
-    for context in contexts:
-        axon.update_context(context)
+    previous = previous or {}
+    current = context.plugins or {}
+    changes = []
 
-        if context.plugins is None:
+    for name, plugin in previous.items():
+        if name in current or applied.removed(context.context, name):
             continue
+        plugin_instance = plugins[name]
+        changes.append(PluginChange(
+            name, REASON_REMOVED, plugin_instance.reference(context.context, plugin)
+        ))
+
+    for name, plugin in current.items():
+        plugin_instance = plugins[name]
+        # rendering can reach the vault (blocking)
+        payload, payload_fingerprint = \
+            await asyncio.to_thread(plugin_instance.render, context.context, plugin)
+
+        reason = change_reason(applied.plugin(context.context, name), payload_fingerprint)
+        reference = None
+
+        if reason is not None and name in previous:
+            # the fingerprint is recorded once the old version is removed: an
+            # applied fingerprint means there is nothing left to do (retries)
+            old = plugin_instance.reference(context.context, previous[name])
+            if old != plugin_instance.reference(context.context, plugin):
+                # this is not the same version so the old configuration is removed
+                reason, reference = REASON_VERSION, old
+
+        if reason is not None:
+            changes.append(PluginChange(name, reason, payload, payload_fingerprint, reference))
+
+    return changes
+
+async def __apply_plugins(context: ContextSpec, changes: List[PluginChange], axon: AxonServer,
+    applied: AppliedContexts):
+    """
+    Configure or remove plugins of a context (removals first)
+    """
+    for change in sorted(changes, key=lambda i: i.reason != REASON_REMOVED):
+        if change.reason == REASON_REMOVED:
+            # await axon.update_context_plugin_status(change.payload, active=False)
+            await axon.remove_context_plugin(change.payload)
+            applied.set_plugin(context.context, change.name, None)
+        else:
+            await axon.update_context_plugin(change.payload)
+            await axon.update_context_plugin_status(change.payload, active=True)
+
+            if change.previous is not None:
+                await axon.remove_context_plugin(change.previous)
+
+            applied.set_plugin(context.context, change.name, change.payload_fingerprint)
+
+        applied.set_change(context.context, change.name, change.reason)
+        metrics.CONTEXT_PLUGIN_CHANGES.labels(change.reason).inc()
+        contexts_logger.info("Plugin %s applied on context %s: %s",
+            change.name, context.context, change.reason)
+
+async def __progress(context: ContextSpec, applied: AppliedContexts, aw: Awaitable):
+    """
+    Report the result of a context and checkpoint the progress
+    """
+    try:
+        await aw
+    except Exception as e:
+        applied.set_result(context.context, e)
+        raise
+    else:
+        applied.set_result(context.context, None)
+    finally:
+        await applied.checkpoint()
+
+async def __cu_context(context: ContextSpec, axon: AxonServer,
+    plugins: Dict[str, InternalPlugin], applied: AppliedContexts):
+    """
+    Create or update a context and its plugins
+    """
+    context_fingerprint = fingerprint(context.context, context.replicationGroup)
+
+    if applied.context(context.context) != context_fingerprint:
+        await axon.update_context(context)
+        applied.set_context(context.context, context_fingerprint)
+
+    await __apply_plugins(
+        context, await __diff_plugins(context, None, plugins, applied), axon, applied
+    )
 
-        for name, plugin in context.plugins.items():
-            __cud_plugin(plugins_idx, name, context, plugin, axon)
+async def __u_context(context: ContextSpec, previous: ContextSpec, axon: AxonServer,
+    plugins: Dict[str, InternalPlugin], applied: AppliedContexts):
+    """
+    Apply plugins changes on an existing context
+    """
+    await __apply_plugins(
+        context, await __diff_plugins(context, previous.plugins, plugins, applied), axon, applied
+    )
 
 @kopf.on.create(settings.GROUP, settings.LATEST_VERSION, CONTEXTS, timeout=settings.DEFAULT_TIMEOUT)
-def ctx_create(instances_idx: kopf.Index, plugins_idx: kopf.Index,
+@metrics.observe_handler(CONTEXTS)
+@handler_deadline(settings.DEFAULT_TIMEOUT)
+async def ctx_create(instances_idx: kopf.Index, plugins_idx: kopf.Index,
     body: kopf.Body, patch: kopf.Patch, **_):
     """
     Create and configure contexts
@@ -68,82 +285,120 @@ def ctx_create(instances_idx: kopf.Index, plugins_idx: kopf.Index,
     patch.status[settings.STATUS_SUCCESS] = False
 
     kcontexts: ContextsKind = ContextsKind.parse_obj(body)
-    axon_instance = instance_from_index(instances_idx, kcontexts.spec.instance)
-
-    with AxonServer(axon_instance) as axon:
-        __cu_contexts(kcontexts.spec.contexts, axon, plugins_idx)
+    axon_instance = await wait_instance(instances_idx, kcontexts.spec.instance)
+    plugins = await __resolve_plugins(plugins_idx, kcontexts.spec.contexts)
+    applied = AppliedContexts(body, patch)
+
+    # contexts are independents and applied in parallel
+    async with AxonServer(axon_instance) as axon:
+        await gather_bounded(
+            contexts_semaphores.get(axon_instance.name),
+            [
+                __progress(context, applied,
+                    __cu_context(context, axon, plugins, applied))
+                for context in kcontexts.spec.contexts
+            ]
+        )
 
     patch.status[settings.STATUS_SUCCESS] = True
 
 @kopf.on.update(settings.GROUP, settings.LATEST_VERSION, CONTEXTS, timeout=settings.DEFAULT_TIMEOUT)
-def ctx_update(instances_idx: kopf.Index, plugins_idx: kopf.Index,
+@metrics.observe_handler(CONTEXTS)
+@handler_deadline(settings.DEFAULT_TIMEOUT)
+async def ctx_update(instances_idx: kopf.Index, plugins_idx: kopf.Index,
     body: kopf.Body, patch: kopf.Patch, old, **_):
     """
     Update contexts
+
+    Plugins changes are computed on rendered payloads (see __diff_plugins), the
+    reason of each change is reported in the progress.
+
+    old is the last handled object: when updates are pushed faster than they are
+    applied, kopf handles the latest object once (intermediate generations are
+    skipped).
     """
     patch.status[settings.STATUS_SUCCESS] = False
 
     kcontexts: ContextsKind = ContextsKind.parse_obj(body)
     previous = ContextsSpec(contexts=old["spec"]["contexts"], instance=old["spec"]["instance"])
 
-    axon_instance = instance_from_index(instances_idx, kcontexts.spec.instance)
-
-    diff_contexts = kcontexts.spec.diff_contexts(previous.contexts)
-
-    with AxonServer(axon_instance) as axon:
-        # Remove contexts
-        # For reference as for now context will never been removed by the operator
-        # for context in diff_contexts.removed:
-        #     pass
-
-        # Add contexts
-        __cu_contexts(diff_contexts.added, axon, plugins_idx)
+    axon_instance = await wait_instance(instances_idx, kcontexts.spec.instance)
+
+    previous_contexts: Dict[str, ContextSpec] = {i.context: i for i in previous.contexts}
+    plugins = await __resolve_plugins(plugins_idx, kcontexts.spec.contexts + [
+        previous_contexts[i.context]
+        for i in kcontexts.spec.contexts if i.context in previous_contexts
+    ])
+    applied = AppliedContexts(body, patch)
+
+    # Remove contexts
+    # For reference as for now context will never been removed by the operator
+    # for context in previous_contexts not in kcontexts.spec.contexts:
+    #     pass
+
+    # contexts are independents and applied in parallel
+    async with AxonServer(axon_instance) as axon:
+        await gather_bounded(
+            contexts_semaphores.get(axon_instance.name),
+            # Add contexts
+            [
+                __progress(context, applied,
+                    __cu_context(context, axon, plugins, applied))
+                for context in kcontexts.spec.contexts
+                if context.context not in previous_contexts
+            ] +
+            # Change contexts: every plugin is rendered and compared to the one applied
+            [
+                __progress(context, applied,
+                    __u_context(context, previous_contexts[context.context], axon,
+                        plugins, applied))
+                for context in kcontexts.spec.contexts
+                if context.context in previous_contexts
+                and (context.plugins or previous_contexts[context.context].plugins)
+            ]
+        )
 
-        # Change contexts
-        for context, diff_plugins in diff_contexts.changed:
-            # Remove plugins
-            for name, plugin in diff_plugins.removed:
-                __cud_plugin(plugins_idx, name, context, plugin, axon, delete=True)
+    patch.status[settings.STATUS_SUCCESS] = True
 
-            # Add plugins
-            for name, plugin in diff_plugins.added:
-                __cud_plugin(plugins_idx, name, context, plugin, axon)
+@kopf.index(settings.GROUP, settings.LATEST_VERSION, CONTEXTS)
+def contexts_idx(body: kopf.Body, **_):
+    """
+    Index all contexts per instance
+    """
+    kcontexts: ContextsKind = ContextsKind.parse_obj(body)
 
-            # Change plugins
-            for name, plugin, old_plugin in diff_plugins.changed:
-                __cud_plugin(plugins_idx, name, context, plugin, axon)
+    return {
+        kcontexts.spec.instance: kcontexts
+    }
 
-                if plugin["version"] != old_plugin["version"]:
-                    # this is not the same version so we will remove the old configuration
-                    __cud_plugin(plugins_idx, name, context, old_plugin, axon, delete=True)
+@kopf.index(settings.GROUP, settings.LATEST_VERSION, CONTEXTS)
+def plugin_contexts_idx(body: kopf.Body, **_):
+    """
+    Index contexts objects per plugin (with the fingerprints applied)
+    """
+    kcontexts: ContextsKind = ContextsKind.parse_obj(body)
+    applied = copy.deepcopy(dict(body.status.get(settings.STATUS_APPLIED, {})))
 
-    patch.status[settings.STATUS_SUCCESS] = True
+    return {
+        name: (kcontexts, applied)
+        for name in {j for i in kcontexts.spec.contexts for j in (i.plugins or {})}
+    }
 
 @kopf.on.validate(settings.GROUP, settings.LATEST_VERSION, CONTEXTS)
-def contextadmission(body: kopf.Body, **_):
+async def contextadmission(body: kopf.Body, old: Optional[kopf.Body], **_):
     """
     Context Admission
 
     instance is immutable
     """
-    if body.meta["generation"] == 1:
-        return
-
-    # previous version already exists. Checking immutable fields
+    with metrics.ADMISSION_DURATION.labels(CONTEXTS).time():
+        if old is None:
+            return
 
-    knew: ContextsKind = ContextsKind.parse_obj(body)
-
-    with kubernetes.client.ApiClient() as api_client:
-        api: kubernetes.client.CustomObjectsApi = kubernetes.client.CustomObjectsApi(api_client)
-        response = api.get_namespaced_custom_object(
-            settings.GROUP,
-            settings.LATEST_VERSION,
-            knew.metadata.namespace,
-            CONTEXTS,
-            knew.metadata.name
-        )
+        # previous version already exists (provided by the admission request).
+        # Checking immutable fields
 
-    kcurrent: ContextsKind = ContextsKind.parse_obj(response)
+        knew: ContextsKind = ContextsKind.parse_obj(body)
 
-    if kcurrent.spec.instance != knew.spec.instance:
-        raise admission_error_immutable(".spec.instance")
+        if old.spec.get("instance") != knew.spec.instance:
+            raise admission_error_immutable(".spec.instance")
@@ -0,0 +1,108 @@
+"""
+Dependents: App and Context objects updated after an Instance or a Plugin change
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+from typing import List, Optional
+import kopf
+from . import metrics, settings
+from .apps import update_binding_url
+from .drift import reconcile_instance
+from .instances import INSTANCES
+from .plugins import PLUGINS, wait_plugin
+from .rollout import COMPLETED, PluginRollout
+from .utils.concurrency import gather_bounded
+from .utils.deadline import handler_deadline
+
+dependents_logger = logging.getLogger("axop.dependents")
+
+@kopf.on.update(settings.GROUP, settings.LATEST_VERSION, INSTANCES, field="spec",
+    timeout=settings.DEFAULT_TIMEOUT)
+@metrics.observe_handler(INSTANCES)
+@handler_deadline(settings.DEFAULT_TIMEOUT)
+async def instance_dependents(name: str, old: dict, new: dict, # pylint: disable=too-many-arguments
+    instances_idx: kopf.Index, plugins_idx: kopf.Index, contexts_idx: kopf.Index,
+    apps_idx: kopf.Index, **_):
+    """
+    Propagate an Instance change to its applications and contexts
+
+    grpc: binding secrets url. http: Axon Server is reconciled (drift) at the new endpoint.
+    """
+    summary = {}
+
+    if old.get("grpc") != new.get("grpc"):
+        kapps = list(apps_idx.get(name, []))
+        updated = await gather_bounded(
+            asyncio.Semaphore(settings.DEPENDENTS_CONCURRENCY),
+            [asyncio.to_thread(update_binding_url, kapp, new["grpc"]) for kapp in kapps]
+        )
+        summary["bindings"] = sum(updated)
+
+    if old.get("http") != new.get("http"):
+        summary["reconciled"] = await reconcile_instance(
+            name, instances_idx, plugins_idx, contexts_idx, apps_idx
+        )
+
+    return summary
+
+def __previous_templates(body: kopf.Body, old: Optional[dict]) -> List[dict]:
+    """
+    Templates that may be configured on the contexts using the plugin
+
+    The previous template and the ones of a rollout that did not complete (eg:
+    paused): its spec is handled, the status is the only trace of them.
+    """
+    rollout = body.status.get(settings.STATUS_ROLLOUT) or {}
+    templates = [] if rollout.get("state") == COMPLETED else list(rollout.get("previous") or [])
+
+    template = (old or {}).get("template")
+    if template and template not in templates:
+        templates.append(template)
+
+    return [i for i in templates if i != body.spec.get("template")]
+
+@kopf.on.update(settings.GROUP, settings.LATEST_VERSION, PLUGINS, field="spec",
+    timeout=settings.DEFAULT_TIMEOUT)
+@metrics.observe_handler(PLUGINS)
+@handler_deadline(settings.DEFAULT_TIMEOUT)
+async def plugin_dependents(name: str, body: kopf.Body, old: dict, # pylint: disable=too-many-arguments
+    instances_idx: kopf.Index, plugins_idx: kopf.Index, plugin_contexts_idx: kopf.Index, **_):
+    """
+    Propagate a Plugin change to the contexts using it
+
+    Only contexts whose rendered payload changed are configured again, in waves
+    (see PluginRollout). A retry resumes with the contexts not applied.
+    """
+    # the index is up to date with the new template
+    plugin = await wait_plugin(plugins_idx, name)
+
+    status = await PluginRollout(plugin, __previous_templates(body, old), instances_idx).run(
+        plugin_contexts_idx.get(name, [])
+    )
+    dependents_logger.info("Rollout of plugin %s: %s", name,
+        {k: v for k, v in status.items() if k not in ("errors", "previous")})
+
+    if status["state"] == COMPLETED and status["failed"] > 0:
+        raise kopf.TemporaryError(
+            f"plugin {name} not applied on {status['failed']} context(s): {status['errors']}"
+        )
+
+    return {"contexts": status["applied"], "state": status["state"]}
@@ -0,0 +1,204 @@
+"""
+Drift detection between Axon Server and App/Context objects
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import logging
+import random
+import time
+from typing import Dict, List, Set, Tuple
+import kopf
+from . import metrics, settings
+from .apps import apply_binding
+from .axon.axonserver import AxonServer
+from .contexts import contexts_semaphores
+from .instances import INSTANCES, InternalInstance, instance_from_index
+from .plugins import plugin_from_index
+from .typing.apps import AppKind
+from .typing.contexts import ContextsKind, ContextSpec
+from .utils.concurrency import gather_bounded
+
+drift_logger = logging.getLogger("axop.drift")
+
+class AxonSnapshot(): # pylint: disable=too-few-public-methods
+    """
+    State of an Axon Server (contexts, applications and plugins) read in one pass
+    """
+
+    def __init__(self, contexts: List[dict], applications: List[dict], plugins: List[dict]):
+        self.taken_at = time.time()
+
+        self.contexts: Set[str] = {i["context"] for i in contexts}
+
+        # application name: {context: roles}
+        self.applications: Dict[str, Dict[str, Set[str]]] = {
+            i["name"]: {j["context"]: set(j["roles"]) for j in i.get("roles") or []}
+            for i in applications
+        }
+
+        # active plugins (context, name, version)
+        self.plugins: Set[Tuple[str, str, str]] = {
+            (j["context"], i["name"], str(i["version"]))
+            for i in plugins
+            for j in i.get("contextInfo") or []
+            if j.get("active")
+        }
+
+    @classmethod
+    async def take(cls, axon: AxonServer) -> 'AxonSnapshot':
+        """Read the Axon Server state"""
+        return cls(*await asyncio.gather(
+            axon.get_contexts(),
+            axon.get_applications(),
+            axon.get_plugins()
+        ))
+
+async def __fix_context(context: ContextSpec, create: bool, plugins: List[Tuple[str, dict]], # pylint: disable=too-many-arguments
+    plugins_idx: kopf.Index, axon: AxonServer):
+    """
+    Create a missing context and/or configure missing plugins
+    """
+    if create:
+        await axon.update_context(context)
+
+    for name, plugin in plugins:
+        plugin_instance = plugin_from_index(plugins_idx, name)
+        # rendering can reach the vault (blocking)
+        payload = await asyncio.to_thread(plugin_instance.get_payload, context.context, plugin)
+
+        await axon.update_context_plugin(payload)
+        await axon.update_context_plugin_status(payload, active=True)
+
+async def __fix_application(kapp: AppKind, register: bool, axon_instance: InternalInstance,
+    axon: AxonServer):
+    """
+    Register a missing application or update its roles
+    """
+    token = await axon.update_application(kapp.metadata.uid, kapp.spec)
+
+    if register:
+        # a new token has been generated
+        await asyncio.to_thread(apply_binding, kapp, axon_instance.grpc, token)
+
+def __contexts_drift(snapshot: AxonSnapshot, kcontexts: ContextsKind, plugins_idx: kopf.Index,
+    skipped: List[str]):
+    """
+    Contexts (with missing plugins) that are not in line with the snapshot
+
+    A context that can not be checked (eg: plugin not indexed) is added to
+    skipped: the other contexts are still checked.
+    """
+    for context in kcontexts.spec.contexts:
+        missing_plugins = []
+
+        try:
+            for name, plugin in (context.plugins or {}).items():
+                plugin_name, version = plugin_from_index(plugins_idx, name).identity(
+                    context.context, plugin
+                )
+                if (context.context, plugin_name, version) not in snapshot.plugins:
+                    missing_plugins.append((name, plugin))
+        except (kopf.TemporaryError, KeyError, ValueError) as e:
+            drift_logger.warning("Drift of context %s (%s/%s) not checked: %s", context.context,
+                kcontexts.metadata.namespace, kcontexts.metadata.name, e)
+            skipped.append(context.context)
+            continue
+
+        missing_context = context.context not in snapshot.contexts
+
+        if missing_context or len(missing_plugins) > 0:
+            yield context, missing_context, missing_plugins
+
+def __applications_drift(snapshot: AxonSnapshot, kapp: AppKind):
+    """
+    Application missing or with roles that are not in line with the snapshot
+    """
+    roles = snapshot.applications.get(kapp.metadata.uid)
+
+    if roles is None:
+        return True, True
+
+    expected = {i.context: {j.value for j in i.roles} for i in kapp.spec.contexts}
+
+    return roles != expected, False
+
+async def reconcile_instance(name: str, instances_idx: kopf.Index, plugins_idx: kopf.Index, # pylint: disable=too-many-locals
+    contexts_idx: kopf.Index, apps_idx: kopf.Index) -> Dict[str, int]:
+    """
+    Detect and correct drift between Axon Server and App/Context objects of an instance
+
+    Axon Server state is read in one pass then only required calls are done.
+    Plugins are checked by name and version (active): a configuration changed
+    on Axon Server is not detected.
+    """
+    axon_instance = instance_from_index(instances_idx, name)
+
+    async with AxonServer(axon_instance) as axon:
+        snapshot = await AxonSnapshot.take(axon)
+
+        fixes = []
+        skipped: List[str] = []
+        summary = {"contexts": 0, "plugins": 0, "applications": 0}
+
+        for kcontexts in contexts_idx.get(name, []):
+            for context, missing_context, missing_plugins in \
+                __contexts_drift(snapshot, kcontexts, plugins_idx, skipped):
+                drift_logger.info(
+                    "Drift on context %s (instance %s): missing=%s, plugins=%s",
+                    context.context, name, missing_context, [i for i, _ in missing_plugins]
+                )
+                summary["contexts"] += int(missing_context)
+                summary["plugins"] += len(missing_plugins)
+                fixes.append(
+                    __fix_context(context, missing_context, missing_plugins, plugins_idx, axon)
+                )
+
+        for kapp in apps_idx.get(name, []):
+            drift, missing = __applications_drift(snapshot, kapp)
+            if drift:
+                drift_logger.info(
+                    "Drift on application %s/%s (instance %s): missing=%s",
+                    kapp.metadata.namespace, kapp.metadata.name, name, missing
+                )
+                summary["applications"] += 1
+                fixes.append(__fix_application(kapp, missing, axon_instance, axon))
+
+        summary["skipped"] = len(skipped)
+
+        await gather_bounded(contexts_semaphores.get(name), fixes)
+
+    return summary
+
+@metrics.observe_handler(INSTANCES)
+async def drift_reconcile(name: str, instances_idx: kopf.Index, plugins_idx: kopf.Index, # pylint: disable=too-many-arguments
+    contexts_idx: kopf.Index, apps_idx: kopf.Index, **_):
+    """
+    Periodic drift detection of an instance (with a jitter)
+    """
+    await asyncio.sleep(random.uniform(0, settings.DRIFT_JITTER))
+
+    return await reconcile_instance(name, instances_idx, plugins_idx, contexts_idx, apps_idx)
+
+if settings.DRIFT_INTERVAL > 0:
+    kopf.timer(
+        settings.GROUP, settings.LATEST_VERSION, INSTANCES,
+        interval=settings.DRIFT_INTERVAL,
+        initial_delay=settings.DRIFT_INTERVAL
+    )(drift_reconcile)
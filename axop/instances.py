@@ -19,13 +19,19 @@ Manages Instances kind
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
+from typing import Optional
 import kopf
-from . import settings
+from . import metrics, settings
 from .typing.instances import InstancesKind
 from .secrets.vault import HashiCorpVault
+from .utils import deadline
+from .utils.waiters import Waiters
 
 INSTANCES='instances'
 
+# handlers waiting for an instance (per name)
+instance_waiters = Waiters()
+
 class InternalInstance():
     """
     Internal Instance
@@ -34,6 +40,11 @@ class InternalInstance():
         self._kinstance = kinstance
         self._axon_token = None
 
+    @property
+    def name(self) -> str:
+        """Instance name"""
+        return self._kinstance.metadata.name
+
     @property
     def http(self) -> str:
         """Axon API endpoint"""
@@ -66,21 +77,47 @@ def instances_idx(body: kopf.Body, **_):
     Index all instances
     """
     kinstance: InstancesKind = InstancesKind.parse_obj(body)
+    instance = InternalInstance(kinstance)
+
+    # handlers blocked on this instance can continue
+    instance_waiters.notify(kinstance.metadata.name, instance)
 
     return {
-        kinstance.metadata.name: InternalInstance(kinstance)
+        kinstance.metadata.name: instance
     }
 
+def __lookup(index: kopf.Index, name: str) -> Optional[InternalInstance]:
+    instances = index.get(name, [])
+
+    if isinstance(instances, kopf.Store) and len(instances) > 0:
+        return list(instances)[-1]
+
+    return None
+
 def instance_from_index(index: kopf.Index, name: str) -> InternalInstance:
     """
     Get internal instance from Index or raise a temporary error
     """
-    instances = index.get(name, [])
+    instance = __lookup(index, name)
 
-    if isinstance(instances, kopf.Store) and len(instances) > 0:
-        instance = list(instances)[-1]
-    else:
-        instance = None
+    if instance is None:
+        raise kopf.TemporaryError(f"instance {name} is not available in index")
+
+    return instance
+
+async def wait_instance(index: kopf.Index, name: str) -> InternalInstance:
+    """
+    Get internal instance from Index or wait for it to be indexed
+
+    A temporary error is raised if it is still missing after DEPENDENCY_WAIT.
+    """
+    instance = __lookup(index, name)
+
+    if instance is None:
+        instance = await instance_waiters.wait(
+            name, lambda: __lookup(index, name), deadline.timeout(settings.DEPENDENCY_WAIT)
+        )
+        metrics.DEPENDENCY_WAITS.labels(INSTANCES, "timeout" if instance is None else "ready").inc()
 
     if instance is None:
         raise kopf.TemporaryError(f"instance {name} is not available in index")
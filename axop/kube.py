@@ -0,0 +1,96 @@
+"""
+Kubernetes API client shared by the operator
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import logging
+import threading
+from typing import Optional
+import kubernetes
+from . import settings
+
+kube_logger = logging.getLogger("axop.kube")
+
+class KubeClient():
+    """
+    Process-wide kubernetes API client
+
+    The configuration is loaded once (in cluster or kubeconfig) and the
+    connections (urllib3 pool, TLS sessions) are reused by all handlers.
+    The client is synchronous: calls must be run in a thread (asyncio.to_thread).
+    """
+
+    def __init__(self):
+        self._api_client: Optional[kubernetes.client.ApiClient] = None
+        self._core_v1: Optional[kubernetes.client.CoreV1Api] = None
+        self._custom_objects: Optional[kubernetes.client.CustomObjectsApi] = None
+        self._lock = threading.Lock()
+
+    def configure(self, configuration: Optional[kubernetes.client.Configuration] = None):
+        """Load the configuration (if not provided) and build the client"""
+        if configuration is None:
+            configuration = kubernetes.client.Configuration()
+            try:
+                kubernetes.config.load_incluster_config(client_configuration=configuration)
+            except kubernetes.config.ConfigException:
+                kubernetes.config.load_kube_config(client_configuration=configuration)
+
+        configuration.connection_pool_maxsize = settings.KUBE_POOL_SIZE
+
+        with self._lock:
+            previous = self._api_client
+            self._api_client = kubernetes.client.ApiClient(configuration)
+            self._core_v1 = kubernetes.client.CoreV1Api(self._api_client)
+            self._custom_objects = kubernetes.client.CustomObjectsApi(self._api_client)
+
+        if previous is not None:
+            previous.close()
+
+        kube_logger.debug("Kubernetes client configured for %s", configuration.host)
+
+    @property
+    def core_v1(self) -> kubernetes.client.CoreV1Api:
+        """Core API (configured on first use if the startup did not)"""
+        core_v1 = self._core_v1
+        if core_v1 is None:
+            self.configure()
+            core_v1 = self._core_v1
+
+        return core_v1
+
+    @property
+    def custom_objects(self) -> kubernetes.client.CustomObjectsApi:
+        """Custom objects API (configured on first use if the startup did not)"""
+        custom_objects = self._custom_objects
+        if custom_objects is None:
+            self.configure()
+            custom_objects = self._custom_objects
+
+        return custom_objects
+
+    def close(self):
+        """Close the connections"""
+        with self._lock:
+            api_client = self._api_client
+            self._api_client, self._core_v1, self._custom_objects = None, None, None
+
+        if api_client is not None:
+            api_client.close()
+
+kube = KubeClient()
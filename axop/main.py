@@ -24,23 +24,28 @@ import re
 import os
 import random
 from typing import AsyncIterator
+from aiohttp import web
 import kopf
+import prometheus_client
+from . import metrics
 from . import settings as axop_settings
+from .axon.pool import sessions as axon_sessions
+from .kube import kube
 
 class FilterAccessLogger(logging.Filter): # pylint: disable=too-few-public-methods
     """
-    /health filter
+    /healthz and /metrics filter
 
     Hidding those requests if we have a 200 OK when we are not in DEBUG
     """
-    regex = re.compile(r'.*"GET /healthz HTTP\/\d.\d" 200 ')
+    regex = re.compile(r'.*"GET /(healthz|metrics) HTTP\/\d.\d" 200 ')
 
     def filter(self, record: logging.LogRecord):
         if record.levelno == logging.DEBUG:
             return True
 
         if FilterAccessLogger.regex.match(record.getMessage()) is not None:
-            # match GET /healthz with code 200
+            # match GET /healthz or /metrics with code 200
             return False
 
         return True
@@ -105,3 +110,47 @@ def configure(settings: kopf.OperatorSettings, **_):
         prefix=axop_settings.DOMAIN,
         key='last-handled-configuration',
     )
+
+    # Kubernetes client (shared by handlers)
+    kube.configure()
+
+async def metrics_endpoint(_: web.Request) -> web.Response:
+    """
+    Prometheus metrics
+    """
+    return web.Response(
+        body=prometheus_client.generate_latest(),
+        headers={"Content-Type": prometheus_client.CONTENT_TYPE_LATEST}
+    )
+
+@kopf.on.startup()
+async def metrics_server(memo: kopf.Memo, **kwargs):
+    """
+    startup: /metrics endpoint and indexes size
+    """
+    # indexes are provided as <name>_idx
+    for name, index in kwargs.items():
+        if name.endswith("_idx"):
+            metrics.INDEX_SIZE.labels(name).set_function(index.__len__)
+
+    if axop_settings.METRICS_PORT == 0:
+        return
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_endpoint)
+
+    # stopped on cleanup
+    memo.metrics_runner = web.AppRunner(app)
+    await memo.metrics_runner.setup()
+    await web.TCPSite(memo.metrics_runner, "0.0.0.0", axop_settings.METRICS_PORT).start()
+
+@kopf.on.cleanup()
+async def cleanup(memo: kopf.Memo, **_):
+    """
+    shutdown
+    """
+    await axon_sessions.close()
+    kube.close()
+
+    if "metrics_runner" in memo:
+        await memo.metrics_runner.cleanup()
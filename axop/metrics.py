@@ -0,0 +1,165 @@
+"""
+Operator metrics (Prometheus)
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import functools
+import time
+from typing import Callable
+from prometheus_client import Counter, Gauge, Histogram
+
+NAMESPACE='axop'
+
+# Handlers
+HANDLER_DURATION = Histogram(
+    'handler_duration_seconds', 'Handler duration', ['resource', 'handler'],
+    namespace=NAMESPACE,
+    buckets=(.01, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0)
+)
+HANDLER_ERRORS = Counter(
+    'handler_errors', 'Handler failures', ['resource', 'handler', 'error'],
+    namespace=NAMESPACE
+)
+
+HANDLER_CHECKPOINTS = Counter(
+    'handler_checkpoints', 'Progress written to the status while a handler is running',
+    ['resource'],
+    namespace=NAMESPACE
+)
+
+DEPENDENCY_WAITS = Counter(
+    'dependency_waits', 'Handlers that waited for an object to be indexed', ['kind', 'result'],
+    namespace=NAMESPACE
+)
+
+CONTEXT_PLUGIN_CHANGES = Counter(
+    'context_plugin_changes', 'Plugin configurations applied on contexts', ['reason'],
+    namespace=NAMESPACE
+)
+
+# Indexes
+INDEX_SIZE = Gauge(
+    'index_size', 'Keys in an index', ['index'],
+    namespace=NAMESPACE
+)
+
+# Admission
+ADMISSION_DURATION = Histogram(
+    'admission_duration_seconds', 'Validating webhook duration', ['resource'],
+    namespace=NAMESPACE,
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0)
+)
+
+# Vault
+VAULT_CLIENT_HITS = Counter(
+    'vault_client_hits', 'Authenticated vault client reused from the registry',
+    namespace=NAMESPACE
+)
+VAULT_CLIENT_MISSES = Counter(
+    'vault_client_misses', 'Vault client created in the registry',
+    namespace=NAMESPACE
+)
+VAULT_LOGINS = Counter(
+    'vault_logins', 'Vault logins (kubernetes auth)', ['addr'],
+    namespace=NAMESPACE
+)
+VAULT_RENEWALS = Counter(
+    'vault_renewals', 'Vault token renewals', ['addr'],
+    namespace=NAMESPACE
+)
+VAULT_REQUEST_DURATION = Histogram(
+    'vault_request_duration_seconds', 'Vault request duration', ['addr', 'operation'],
+    namespace=NAMESPACE
+)
+VAULT_SECRET_CACHE_HITS = Counter(
+    'vault_secret_cache_hits', 'Secret served from the cache',
+    namespace=NAMESPACE
+)
+VAULT_SECRET_CACHE_REVALIDATIONS = Counter(
+    'vault_secret_cache_revalidations', 'Expired secret still valid (same version)',
+    namespace=NAMESPACE
+)
+VAULT_SECRET_CACHE_MISSES = Counter(
+    'vault_secret_cache_misses', 'Secret value read from the vault',
+    namespace=NAMESPACE
+)
+
+# Axon Server
+AXON_REQUEST_DURATION = Histogram(
+    'axon_request_duration_seconds', 'Axon Server request duration',
+    ['instance', 'method', 'endpoint'],
+    namespace=NAMESPACE
+)
+AXON_RESPONSES = Counter(
+    'axon_responses', 'Axon Server responses (status "error" on network error)',
+    ['instance', 'method', 'endpoint', 'status'],
+    namespace=NAMESPACE
+)
+AXON_CONCURRENCY_LIMIT = Gauge(
+    'axon_concurrency_limit', 'Concurrent Axon Server requests allowed', ['instance'],
+    namespace=NAMESPACE
+)
+AXON_RATE_LIMIT = Gauge(
+    'axon_rate_limit', 'Axon Server requests per second allowed', ['instance'],
+    namespace=NAMESPACE
+)
+AXON_IN_FLIGHT = Gauge(
+    'axon_in_flight', 'Axon Server requests in flight', ['instance'],
+    namespace=NAMESPACE
+)
+AXON_QUEUE_DEPTH = Gauge(
+    'axon_queue_depth', 'Axon Server requests waiting for a concurrency slot', ['instance'],
+    namespace=NAMESPACE
+)
+AXON_RETRIES = Counter(
+    'axon_retries', 'Axon Server requests retried', ['instance'],
+    namespace=NAMESPACE
+)
+AXON_DEDUPLICATED = Counter(
+    'axon_deduplicated', 'Axon Server requests sharing an identical request in flight',
+    ['instance'],
+    namespace=NAMESPACE
+)
+AXON_BREAKER_STATE = Gauge(
+    'axon_breaker_state', 'Circuit breaker state (0: closed, 1: open, 2: half-open)',
+    ['instance'],
+    namespace=NAMESPACE
+)
+
+def observe_handler(resource: str) -> Callable:
+    """
+    Decorator for async handlers: duration and failures
+    """
+    def decorator(fn: Callable) -> Callable:
+        duration = HANDLER_DURATION.labels(resource, fn.__name__)
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            started = time.monotonic()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception as e:
+                HANDLER_ERRORS.labels(resource, fn.__name__, type(e).__name__).inc()
+                raise
+            finally:
+                duration.observe(time.monotonic() - started)
+
+        return wrapper
+
+    return decorator
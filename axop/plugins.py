@@ -19,25 +19,98 @@ Manages Plugin kind
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
+from typing import Optional, Tuple
 import kopf
-import yaml
-from . import settings
-from .typing.plugins import PluginKind
+from . import metrics, settings
+from .typing.plugins import PluginKind, RolloutSpec, TemplateSpec
 from .secrets.vault import unravel_mysteries
+from .utils.fingerprint import fingerprint
+from .utils import deadline
+from .utils.template import PayloadTemplate, TemplateError
+from .utils.waiters import Waiters
 
 PLUGINS='plugins'
 
-class InternalPlugin(): # pylint: disable=too-few-public-methods
+# reasons of a plugin (re)configuration on a context
+REASON_ADDED='added'
+REASON_REMOVED='removed'
+REASON_PAYLOAD='payload'
+REASON_SECRETS='secrets'
+REASON_VERSION='version'
+
+# handlers waiting for a plugin (per name)
+plugin_waiters = Waiters()
+
+class InternalPlugin():
     """
     Internal Plugin
     """
     def __init__(self, kplugin: PluginKind):
         self._kplugin = kplugin
+        # parsed once (raise TemplateError)
+        self._template = PayloadTemplate(
+            kplugin.spec.template.payload,
+            kplugin.spec.template.variables
+        )
+
+    @property
+    def name(self) -> str:
+        """Plugin object name"""
+        return self._kplugin.metadata.name
+
+    @property
+    def rollout(self) -> RolloutSpec:
+        """Rollout settings of a template change"""
+        return self._kplugin.spec.rollout or RolloutSpec()
+
+    def with_template(self, template: dict) -> "InternalPlugin":
+        """
+        Same plugin with another template (raise ValueError if it is not valid)
+        """
+        spec = self._kplugin.spec.copy(update={"template": TemplateSpec.parse_obj(template)})
+
+        return InternalPlugin(self._kplugin.copy(update={"spec": spec}))
 
     def get_payload(self, context: str, plugin: dict) -> dict:
         """
         Replace required fields in the payload
         """
+        return self.render(context, plugin)[0]
+
+    def render(self, context: str, plugin: dict) -> Tuple[dict, str]:
+        """
+        Replace required fields in the payload and return it with its fingerprint
+
+        The fingerprint covers the payload without secret values and the secrets
+        versions (payload:secrets, see change_reason)
+        """
+        payload = self._format(context, plugin)
+
+        without_secrets = fingerprint(payload)
+        versions = unravel_mysteries(payload)
+
+        return payload, f"{without_secrets}:{fingerprint(versions)}"
+
+    def identity(self, context: str, plugin: dict) -> Tuple[str, str]:
+        """
+        Axon plugin name and version configured by the payload (secrets are not read)
+        """
+        payload = self._format(context, plugin)
+
+        return payload["name"], str(payload["version"])
+
+    def reference(self, context: str, plugin: dict) -> dict:
+        """
+        Fields identifying the plugin configured on the context (secrets are not read)
+        """
+        name, version = self.identity(context, plugin)
+
+        return {"context": context, "name": name, "version": version}
+
+    def _format(self, context: str, plugin: dict) -> dict:
+        """
+        Replace required fields in the payload template
+        """
         required = self._kplugin.spec.template.variables
         values = {}
 
@@ -47,13 +120,22 @@ class InternalPlugin(): # pylint: disable=too-few-public-methods
                 continue
             values[i] = plugin[i]
 
-        payload = yaml.safe_load(
-            self._kplugin.spec.template.payload.format(**values)
-        )
+        return self._template.render(values)
+
+def change_reason(applied: Optional[str], rendered: str) -> Optional[str]:
+    """
+    Why a rendered payload has to be applied again (None if it is the one applied)
+
+    payload: the configuration changed. secrets: only secrets versions changed.
+    """
+    if applied == rendered:
+        return None
+    if applied is None:
+        return REASON_ADDED
 
-        unravel_mysteries(payload)
+    payload, _, _ = applied.partition(":")
 
-        return payload
+    return REASON_SECRETS if payload == rendered.partition(":")[0] else REASON_PAYLOAD
 
 @kopf.index(settings.GROUP, settings.LATEST_VERSION, PLUGINS)
 def plugins_idx(body: kopf.Body, **_):
@@ -61,23 +143,63 @@ def plugins_idx(body: kopf.Body, **_):
     Index all plugins
     """
     kplugin: PluginKind = PluginKind.parse_obj(body)
+    plugin = InternalPlugin(kplugin)
+
+    # handlers blocked on this plugin can continue
+    plugin_waiters.notify(kplugin.metadata.name, plugin)
 
     return {
-        kplugin.metadata.name: InternalPlugin(kplugin)
+        kplugin.metadata.name: plugin
     }
 
+def __lookup(index: kopf.Index, name: str) -> Optional[InternalPlugin]:
+    plugins = index.get(name, [])
+
+    if isinstance(plugins, kopf.Store) and len(plugins) > 0:
+        return list(plugins)[-1]
+
+    return None
+
 def plugin_from_index(index: kopf.Index, name: str) -> InternalPlugin:
     """
     Get internal plugin from Index or raise a temporary error
     """
-    plugins = index.get(name, [])
+    plugin = __lookup(index, name)
 
-    if isinstance(plugins, kopf.Store) and len(plugins) > 0:
-        plugin = list(plugins)[-1]
-    else:
-        plugin = None
+    if plugin is None:
+        raise kopf.TemporaryError(f"plugin {name} is not available in index")
+
+    return plugin
+
+async def wait_plugin(index: kopf.Index, name: str) -> InternalPlugin:
+    """
+    Get internal plugin from Index or wait for it to be indexed
+
+    A temporary error is raised if it is still missing after DEPENDENCY_WAIT.
+    """
+    plugin = __lookup(index, name)
+
+    if plugin is None:
+        plugin = await plugin_waiters.wait(
+            name, lambda: __lookup(index, name), deadline.timeout(settings.DEPENDENCY_WAIT)
+        )
+        metrics.DEPENDENCY_WAITS.labels(PLUGINS, "timeout" if plugin is None else "ready").inc()
 
     if plugin is None:
         raise kopf.TemporaryError(f"plugin {name} is not available in index")
 
     return plugin
+
+@kopf.on.validate(settings.GROUP, settings.LATEST_VERSION, PLUGINS)
+async def pluginadmission(body: kopf.Body, **_):
+    """
+    Plugin Admission
+
+    template payload must be valid
+    """
+    kplugin: PluginKind = PluginKind.parse_obj(body)
+
+    try:
+        PayloadTemplate(kplugin.spec.template.payload, kplugin.spec.template.variables)
+    except TemplateError as e:
+        raise kopf.AdmissionError(str(e))
@@ -0,0 +1,253 @@
+"""
+Rollout of a Plugin change to the contexts using it
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import collections
+import logging
+from typing import Dict, Iterable, List, Optional, Tuple
+import kopf
+from . import settings
+from .axon.axonserver import AxonServer
+from .contexts import CONTEXTS
+from .instances import wait_instance
+from .kube import kube
+from .plugins import PLUGINS, InternalPlugin, change_reason
+from .typing.contexts import ContextsKind, ContextSpec
+
+rollout_logger = logging.getLogger("axop.rollout")
+
+RUNNING='Running'
+PAUSED='Paused'
+COMPLETED='Completed'
+
+# errors kept in the status
+MAX_ERRORS=20
+
+class Target(): # pylint: disable=too-few-public-methods
+    """A context using the plugin"""
+    def __init__(self, kcontexts: ContextsKind, applied: dict, context: ContextSpec):
+        self.kcontexts = kcontexts
+        self.applied = applied
+        self.context = context
+        self.payload: Optional[dict] = None
+        self.fingerprint: Optional[str] = None
+        # references of the previous plugin versions to remove
+        self.previous: List[dict] = []
+
+    @property
+    def key(self) -> str:
+        """namespace/object/context"""
+        metadata = self.kcontexts.metadata
+        return f"{metadata.namespace}/{metadata.name}/{self.context.context}"
+
+class PluginRollout(): # pylint: disable=too-few-public-methods
+    """
+    Push a plugin change to the contexts using it
+
+    Payloads are rendered again and compared to the fingerprints applied: only
+    changed contexts are configured, in waves (waveSize) with a concurrency
+    limit. The rollout is paused when the error rate exceeds maxErrorRate.
+    Progress is reported in the Plugin status.
+
+    When the template changes the plugin name or version, the configuration
+    rendered with a previous template is removed. Previous templates are kept
+    in the status until the rollout completes: a paused rollout is resumed with
+    them (kopf records the new spec as handled).
+    """
+
+    def __init__(self, plugin: InternalPlugin, previous: List[dict],
+        instances_idx: kopf.Index):
+        self._plugin = plugin
+        self._previous = [i for i in (self._parse(i) for i in previous) if i is not None]
+        self._instances_idx = instances_idx
+        self._spec = plugin.rollout
+        self._semaphore = asyncio.Semaphore(
+            self._spec.concurrency or settings.DEPENDENTS_CONCURRENCY
+        )
+
+        self.status = {
+            "state": RUNNING,
+            "total": 0,
+            "changed": 0,
+            "applied": 0,
+            "failed": 0,
+            "wave": 0,
+            "waves": 0,
+            "errors": [],
+            "previous": previous
+        }
+
+    async def run(self, entries: Iterable[Tuple[ContextsKind, dict]]) -> dict:
+        """Plan and apply the rollout, return its status"""
+        targets = self._targets(entries)
+        self.status["total"] = len(targets)
+
+        changed = [i for i in await self._bounded(self._render, targets) if i is not None]
+        self.status["changed"] = len(changed)
+
+        size = max(1, self._spec.waveSize)
+        waves = [changed[i:i + size] for i in range(0, len(changed), size)]
+        self.status["waves"] = len(waves)
+
+        for wave in waves:
+            if self._spec.paused:
+                self.status["state"] = PAUSED
+                break
+
+            self.status["wave"] += 1
+            applied = [i for i in await self._bounded(self._apply, wave) if i is not None]
+            await self._record(applied)
+
+            self.status["applied"] += len(applied)
+
+            attempted = self.status["applied"] + self.status["failed"]
+            if self.status["failed"] / attempted > self._spec.maxErrorRate:
+                rollout_logger.warning("Rollout of plugin %s paused: %d/%d failed",
+                    self._plugin.name, self.status["failed"], attempted)
+                self.status["state"] = PAUSED
+                break
+
+            await self._report()
+        else:
+            self.status["state"] = COMPLETED
+            # removed from the status (merge patch)
+            self.status["previous"] = None
+
+        await self._report()
+
+        return self.status
+
+    def _targets(self, entries: Iterable[Tuple[ContextsKind, dict]]) -> List[Target]:
+        targets = [
+            Target(kcontexts, applied, context)
+            for kcontexts, applied in entries
+            for context in kcontexts.spec.contexts
+            if self._plugin.name in (context.plugins or {})
+        ]
+
+        return sorted(targets, key=lambda i: i.key)
+
+    async def _bounded(self, fn, targets: List[Target]) -> List[Optional[Target]]:
+        async def bounded(target: Target):
+            async with self._semaphore:
+                return await fn(target)
+
+        return await asyncio.gather(*[bounded(i) for i in targets])
+
+    def _failed(self, target: Target, error: Exception):
+        self.status["failed"] += 1
+        if len(self.status["errors"]) < MAX_ERRORS:
+            self.status["errors"].append({
+                "context": target.key,
+                "error": f"{type(error).__name__}: {error}"[:256]
+            })
+
+    def _parse(self, template: dict) -> Optional[InternalPlugin]:
+        """Plugin with a previous template (None if it is not valid: nothing was configured)"""
+        try:
+            return self._plugin.with_template(template)
+        except ValueError:
+            return None
+
+    def _previous_references(self, target: Target) -> List[dict]:
+        """Plugins configured by the previous templates with another name or version"""
+        context, plugin = target.context.context, target.context.plugins[self._plugin.name]
+        current = self._plugin.reference(context, plugin)
+
+        references: List[dict] = []
+        for previous in self._previous:
+            try:
+                reference = previous.reference(context, plugin)
+            except (KeyError, ValueError):
+                # the previous template could not be rendered: nothing was configured
+                continue
+            if reference != current and reference not in references:
+                references.append(reference)
+
+        return references
+
+    async def _render(self, target: Target) -> Optional[Target]:
+        """Render the payload (target returned if it changed)"""
+        try:
+            # rendering can reach the vault (blocking)
+            target.payload, target.fingerprint = await asyncio.to_thread(
+                self._plugin.render,
+                target.context.context, target.context.plugins[self._plugin.name]
+            )
+        except Exception as e: # pylint: disable=broad-except
+            self._failed(target, e)
+            return None
+
+        target.previous = self._previous_references(target)
+
+        applied = ((target.applied.get(target.context.context) or {}).get("plugins") or {})
+        if change_reason(applied.get(self._plugin.name), target.fingerprint) is None:
+            return None
+
+        return target
+
+    async def _apply(self, target: Target) -> Optional[Target]:
+        """Configure the plugin on the context (target returned if applied)"""
+        try:
+            axon_instance = await wait_instance(self._instances_idx, target.kcontexts.spec.instance)
+            async with AxonServer(axon_instance) as axon:
+                await axon.update_context_plugin(target.payload)
+                await axon.update_context_plugin_status(target.payload, active=True)
+
+                # another name or version: the previous configurations are removed
+                for previous in target.previous:
+                    await axon.remove_context_plugin(previous)
+        except Exception as e: # pylint: disable=broad-except
+            self._failed(target, e)
+            return None
+
+        return target
+
+    async def _record(self, targets: List[Target]):
+        """Fingerprints applied written in the Context status (one patch per object)"""
+        updates: Dict[Tuple[str, str], dict] = collections.defaultdict(dict)
+        for target in targets:
+            metadata = target.kcontexts.metadata
+            updates[(metadata.namespace, metadata.name)][target.context.context] = {
+                "plugins": {self._plugin.name: target.fingerprint}
+            }
+
+        for (namespace, name), applied in updates.items():
+            # same fingerprints as the contexts handlers: later updates are skipped
+            await asyncio.to_thread(
+                kube.custom_objects.patch_namespaced_custom_object,
+                settings.GROUP, settings.LATEST_VERSION, namespace, CONTEXTS, name,
+                {"status": {settings.STATUS_APPLIED: applied}},
+                _content_type="application/merge-patch+json"
+            )
+
+    async def _report(self):
+        """Progress in the Plugin status (best effort)"""
+        try:
+            await asyncio.to_thread(
+                kube.custom_objects.patch_cluster_custom_object,
+                settings.GROUP, settings.LATEST_VERSION, PLUGINS, self._plugin.name,
+                {"status": {settings.STATUS_ROLLOUT: self.status}},
+                _content_type="application/merge-patch+json"
+            )
+        except Exception as e: # pylint: disable=broad-except
+            rollout_logger.warning("Rollout status of plugin %s not written: %s",
+                self._plugin.name, e)
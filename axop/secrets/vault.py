@@ -24,13 +24,19 @@ env:
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
+import contextvars
 import os
 import logging
-from typing import Optional, Any, Dict
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Any, Dict, List, Set, Tuple
 from pathlib import Path
 import hvac
 from . import VaultGenericException
+from .. import metrics, settings
 from ..typing.vault import HashiCorpVaultSpec
+from ..utils import deadline
 
 # class ListworkaroundRequest(hvac.adapters.Request):
 #     """workaround for an HTTP/2 issue with LIST/istio/vault on kubernetes"""
@@ -45,24 +51,36 @@ from ..typing.vault import HashiCorpVaultSpec
 #         return hvac.adapters.Request.request(
 #             self, method, url, headers=headers, raise_exception=raise_exception, **kwargs)
 
+class DeadlineAdapter(hvac.adapters.JSONAdapter):
+    """Vault requests with connect/read timeouts bounded by the handler deadline"""
+
+    def request(self, *args, **kwargs):
+        """override request function to set the timeout"""
+
+        kwargs["timeout"] = (
+            deadline.timeout(settings.VAULT_CONNECT_TIMEOUT),
+            deadline.timeout(settings.VAULT_READ_TIMEOUT)
+        )
+
+        return hvac.adapters.JSONAdapter.request(self, *args, **kwargs)
+
 vault_logger = logging.getLogger("axop.vault")
 
-class HashiCorpVault:
+class HashiCorpVault: # pylint: disable=too-many-instance-attributes
     """Vault helper
 
     Purpose is to find the proper context to connect to the vault and to provide read functions.
     """
 
+    # renew the token when less than this ratio of the lease remains
+    RENEW_RATIO = 0.25
+
     @classmethod
     def get_one_secret(cls, spec: HashiCorpVaultSpec) -> Any:
         """
-        Initialize the vault and return the secret requested (All-in-one)
+        Return the secret requested with a shared authenticated vault (All-in-one)
         """
-        vault = HashiCorpVault(spec.auth, spec.addr, spec.role)
-        vault.connect()
-        result = vault.read_secret(spec.path, spec.mount)
-
-        return result[spec.field]
+        return secrets.read(spec)[spec.field]
 
     def __init__(self, auth: str = "kubernetes",
         addr: str = "http://localhost:8200", role: str = "default"):
@@ -70,6 +88,10 @@ class HashiCorpVault:
         self._k8s_auth = auth
         self._token = None
         self._client = None
+        self._lock = threading.Lock()
+        self._lease_duration = 0
+        self._lease_expires_at: Optional[float] = None
+        self._renewable = False
 
         self._addr = os.environ.get("VAULT_ADDR", addr)
         self._role = os.environ.get("VAULT_ROLE", role)
@@ -95,20 +117,80 @@ class HashiCorpVault:
     def connect(self):
         """Connect to the Vault"""
         # client = hvac.Client(url=self._addr, adapter=ListworkaroundRequest)
-        client = hvac.Client(url=self._addr)
+        client = hvac.Client(url=self._addr, adapter=DeadlineAdapter)
 
         if self._k8s:
+            # projected service account tokens are rotated by the kubelet
+            self._token = self._get_token_from_kubernetes()
+
             # Deprecated but not well documented so we keep it as a reference for now
             # client.auth_kubernetes(self._role, self._token, mount_point=self._k8s_auth)
-            client.auth.kubernetes.login(self._role, self._token, mount_point=self._k8s_auth)
+            with metrics.VAULT_REQUEST_DURATION.labels(self._addr, "login").time():
+                response = client.auth.kubernetes.login(
+                    self._role, self._token, mount_point=self._k8s_auth
+                )
+            metrics.VAULT_LOGINS.labels(self._addr).inc()
+            self._set_lease(response["auth"])
         elif self._token is not None:
             client.token = self._token
+            self._set_lease(None)
         if not client.is_authenticated():
             raise VaultGenericException(f"Auth failure on {self._addr} !")
 
         self._client = client
         vault_logger.info("Auth succeed on %s", self._addr)
 
+    def _set_lease(self, auth: Optional[dict]):
+        """Keep track of the token lease (no expiration if not provided)"""
+        self._lease_duration = 0 if auth is None else auth.get("lease_duration", 0)
+        self._renewable = False if auth is None else auth.get("renewable", False)
+
+        if self._lease_duration > 0:
+            self._lease_expires_at = time.monotonic() + self._lease_duration
+        else:
+            self._lease_expires_at = None
+
+    def ensure_authenticated(self):
+        """
+        Connect, renew or reconnect the client depending on the token lease
+        """
+        with self._lock:
+            if self._client is None:
+                self.connect()
+                return
+
+            if self._lease_expires_at is None:
+                return
+
+            remaining = self._lease_expires_at - time.monotonic()
+
+            if remaining <= 0:
+                vault_logger.debug("Token expired on %s", self._addr)
+                self.connect()
+            elif remaining < self._lease_duration * HashiCorpVault.RENEW_RATIO:
+                self._renew()
+
+    def _renew(self):
+        """Renew the token lease or login again if not possible"""
+        if not self._renewable:
+            self.connect()
+            return
+
+        try:
+            with metrics.VAULT_REQUEST_DURATION.labels(self._addr, "renew").time():
+                response = self._client.auth.token.renew_self()
+            metrics.VAULT_RENEWALS.labels(self._addr).inc()
+            self._set_lease(response["auth"])
+            vault_logger.debug("Token renewed on %s", self._addr)
+        except hvac.exceptions.VaultError:
+            vault_logger.debug("Token renewal failed on %s", self._addr, exc_info=True)
+            self.connect()
+
+    def reconnect(self):
+        """Login again (eg: token revoked)"""
+        with self._lock:
+            self.connect()
+
     @classmethod
     def _get_token_from_kubernetes(cls):
         """Get the service account token from a Pod"""
@@ -127,15 +209,148 @@ class HashiCorpVault:
         if self._client is None:
             raise VaultGenericException(f"Not connected to {self._addr} !")
 
+    def _kv2(self, method: str, path: str, mount_point: str) -> dict:
+        """Call a KV v2 method (login again once on forbidden)"""
+
+        self.assert_valid_client()
+
+        duration = metrics.VAULT_REQUEST_DURATION.labels(self._addr, method)
+
+        try:
+            with duration.time():
+                return getattr(self._client.secrets.kv.v2, method)(path, mount_point=mount_point)
+        except hvac.exceptions.Forbidden:
+            # token revoked or expired before its lease. login again once.
+            vault_logger.debug("Forbidden on %s, login again", self._addr)
+            self.reconnect()
+            with duration.time():
+                return getattr(self._client.secrets.kv.v2, method)(path, mount_point=mount_point)
+
     def read_secret(self, path: str, mount_point: str = "secret") -> Optional[dict]:
         """Read a secret"""
+        return self.read_secret_versioned(path, mount_point)[0]
 
-        self.assert_valid_client()
+    def read_secret_versioned(self, path: str, mount_point: str = "secret") -> Tuple[dict, int]:
+        """Read a secret and its version"""
+        response = self._kv2("read_secret_version", path, mount_point)
+        return response['data']['data'], response['data']['metadata']['version']
 
-        response = self._client.secrets.kv.v2.read_secret_version(path, mount_point=mount_point)
-        return response['data']['data']
+    def read_secret_current_version(self, path: str, mount_point: str = "secret") -> int:
+        """Read the current version of a secret (metadata only)"""
+        response = self._kv2("read_secret_metadata", path, mount_point)
+        return response['data']['current_version']
 
-def unravel_mysteries(var: dict, vault_key: str='hashicorpVault'):
+class VaultClients():
+    """
+    Process-wide registry of authenticated vault clients
+
+    Clients are shared per (addr, role, auth) and reauthenticated only when needed.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._vaults: Dict[Tuple[str, str, str], HashiCorpVault] = {}
+
+    def __len__(self) -> int:
+        return len(self._vaults)
+
+    def get(self, spec: HashiCorpVaultSpec) -> HashiCorpVault:
+        """Get an authenticated vault for the spec"""
+        key = (spec.addr, spec.role, spec.auth)
+
+        with self._lock:
+            vault = self._vaults.get(key)
+            if vault is None:
+                metrics.VAULT_CLIENT_MISSES.inc()
+                vault = HashiCorpVault(spec.auth, spec.addr, spec.role)
+                self._vaults[key] = vault
+            else:
+                metrics.VAULT_CLIENT_HITS.inc()
+
+        vault.ensure_authenticated()
+
+        return vault
+
+vaults = VaultClients()
+
+class _CachedSecret(): # pylint: disable=too-few-public-methods
+    """One secret value with its KV v2 version"""
+    def __init__(self, data: dict, version: int):
+        self.data = data
+        self.version = version
+        self.expires_at = time.monotonic() + settings.VAULT_SECRET_TTL
+
+class SecretsCache():
+    """
+    Process-wide cache of KV v2 secrets keyed by (addr, mount, path)
+
+    A secret is served from memory during VAULT_SECRET_TTL. Once expired, only
+    its metadata is read: the value is read again only if the version changed.
+    Secrets whose metadata can not be read (policy without <mount>/metadata/*)
+    are always read again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._secrets: Dict[Tuple[str, str, str], _CachedSecret] = {}
+        # metadata forbidden by the policy
+        self._no_metadata: Set[Tuple[str, str, str]] = set()
+
+    def __len__(self) -> int:
+        return len(self._secrets)
+
+    def read(self, spec: HashiCorpVaultSpec) -> dict:
+        """Read a secret"""
+        return self.read_versioned(spec)[0]
+
+    def read_versioned(self, spec: HashiCorpVaultSpec) -> Tuple[dict, int]:
+        """Read a secret and its version"""
+        key = (spec.addr, spec.mount, spec.path)
+
+        with self._lock:
+            cached = self._secrets.get(key)
+
+        if cached is not None and cached.expires_at > time.monotonic():
+            metrics.VAULT_SECRET_CACHE_HITS.inc()
+            return cached.data, cached.version
+
+        vault = vaults.get(spec)
+
+        if cached is not None and \
+            self._current_version(vault, key) == cached.version:
+            # still valid
+            metrics.VAULT_SECRET_CACHE_REVALIDATIONS.inc()
+            cached = _CachedSecret(cached.data, cached.version)
+        else:
+            metrics.VAULT_SECRET_CACHE_MISSES.inc()
+            cached = _CachedSecret(*vault.read_secret_versioned(spec.path, spec.mount))
+
+        with self._lock:
+            self._secrets[key] = cached
+
+        return cached.data, cached.version
+
+    def _current_version(self, vault: HashiCorpVault, key: Tuple[str, str, str]) -> Optional[int]:
+        """Current version of a secret (None if its metadata can not be read)"""
+        if key in self._no_metadata:
+            return None
+
+        _, mount, path = key
+        try:
+            return vault.read_secret_current_version(path, mount)
+        except hvac.exceptions.Forbidden:
+            vault_logger.info("Metadata of %s/%s not readable, secret read on expiry", mount, path)
+            with self._lock:
+                self._no_metadata.add(key)
+            return None
+
+secrets = SecretsCache()
+
+_executor = ThreadPoolExecutor(
+    max_workers=settings.VAULT_CONCURRENCY, thread_name_prefix="axop-vault"
+)
+
+def unravel_mysteries(var: dict, vault_key: str='hashicorpVault') -> Dict[str, int]:
     """
     Find hashicorpVault key compliant with HashiCorpVaultSpec
     and replace the previous key with the secret value
@@ -152,22 +367,40 @@ def unravel_mysteries(var: dict, vault_key: str='hashicorpVault'):
 
     will become:
     azureServicePrincipalSecret: 'mysecret'
+
+    All secrets are collected first then read concurrently (once per secret path).
+
+    Return the version of each secret read (key: addr/mount/path)
     """
-    _vault_cache: Dict[str, HashiCorpVault] = {}
+    references: List[Tuple[dict, str, HashiCorpVaultSpec]] = []
 
     def lookin(var: dict):
         for key, value in var.items():
             if isinstance(value, dict):
                 if vault_key in value:
                     spec: HashiCorpVaultSpec = HashiCorpVaultSpec.parse_obj(value[vault_key])
-                    vault = _vault_cache.get(spec.addr)
-                    if vault is None:
-                        vault = HashiCorpVault(spec.auth, spec.addr, spec.role)
-                        vault.connect()
-                        _vault_cache[spec.addr] = vault
-
-                    var[key] = vault.read_secret(spec.path, spec.mount)[spec.field]
+                    references.append((var, key, spec))
                 else:
                     lookin(value)
 
     lookin(var)
+
+    # one read per secret path
+    specs: Dict[Tuple[str, str, str], HashiCorpVaultSpec] = {
+        (spec.addr, spec.mount, spec.path): spec for _, _, spec in references
+    }
+
+    if len(specs) > 1:
+        # each thread runs with a copy of the caller context (deadline)
+        futures = [
+            _executor.submit(contextvars.copy_context().run, secrets.read_versioned, spec)
+            for spec in specs.values()
+        ]
+        values = dict(zip(specs, [i.result() for i in futures]))
+    else:
+        values = {key: secrets.read_versioned(spec) for key, spec in specs.items()}
+
+    for parent, key, spec in references:
+        parent[key] = values[(spec.addr, spec.mount, spec.path)][0][spec.field]
+
+    return {"/".join(key): version for key, (_, version) in values.items()}
@@ -17,6 +17,8 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
+import os
+
 DOMAIN='bleuelab.ca'
 OPERATOR='axop'
 GROUP=f'axoniq.{DOMAIN}'
@@ -28,17 +30,63 @@ WATCHING_SERVER_TIMEOUT=1*60
 WATCHING_CONNECT_TIMEOUT=1*60
 
 STATUS_SUCCESS='lastOperationSuccess'
-
-BINDING=\
-"""
-apiVersion: v1
-kind: Secret
-metadata:
-  name: {name}
-type: Opaque
-data:
-  token: '{token}'
-  url: '{grpc}'
-"""
+STATUS_APPLIED='applied'
+STATUS_PROGRESS='progress'
+STATUS_ROLLOUT='rollout'
 
 ENV_HOST='AXOP_HOST'
+
+# Objects updated in parallel after an Instance or a Plugin change
+DEPENDENTS_CONCURRENCY=int(os.environ.get('AXOP_DEPENDENTS_CONCURRENCY', '10'))
+
+# Handlers wait for a missing instance or plugin to be indexed (seconds, 0 to disable)
+DEPENDENCY_WAIT=int(os.environ.get('AXOP_DEPENDENCY_WAIT', '120'))
+
+# Progress of long handlers written to the status (seconds between patches, 0 to disable)
+CHECKPOINT_INTERVAL=float(os.environ.get('AXOP_CHECKPOINT_INTERVAL', '5'))
+
+# Prometheus /metrics endpoint (0 to disable)
+METRICS_PORT=int(os.environ.get('AXOP_METRICS_PORT', '5002'))
+
+# Axon Server connection pool (per instance)
+AXON_POOL_SIZE=int(os.environ.get('AXOP_AXON_POOL_SIZE', '20'))
+AXON_POOL_KEEPALIVE=int(os.environ.get('AXOP_AXON_POOL_KEEPALIVE', '30'))
+AXON_POOL_IDLE_TIMEOUT=int(os.environ.get('AXOP_AXON_POOL_IDLE_TIMEOUT', str(10*60)))
+
+# Axon Server timeouts (seconds, bounded by the handler deadline)
+AXON_CONNECT_TIMEOUT=float(os.environ.get('AXOP_AXON_CONNECT_TIMEOUT', '5'))
+AXON_READ_TIMEOUT=float(os.environ.get('AXOP_AXON_READ_TIMEOUT', '30'))
+AXON_WRITE_TIMEOUT=float(os.environ.get('AXOP_AXON_WRITE_TIMEOUT', '60'))
+
+# Axon Server adaptive limits (per instance)
+AXON_RATE_LIMIT=int(os.environ.get('AXOP_AXON_RATE_LIMIT', '50'))
+AXON_RATE_BURST=int(os.environ.get('AXOP_AXON_RATE_BURST', '10'))
+AXON_CONCURRENCY_LIMIT=int(os.environ.get('AXOP_AXON_CONCURRENCY_LIMIT', str(AXON_POOL_SIZE)))
+AXON_LATENCY_TARGET=float(os.environ.get('AXOP_AXON_LATENCY_TARGET', '2.0'))
+
+# Axon Server retries on transient errors and circuit breaker (per instance)
+AXON_RETRIES=int(os.environ.get('AXOP_AXON_RETRIES', '3'))
+AXON_RETRY_BACKOFF=float(os.environ.get('AXOP_AXON_RETRY_BACKOFF', '0.5'))
+AXON_RETRY_BACKOFF_MAX=float(os.environ.get('AXOP_AXON_RETRY_BACKOFF_MAX', '10'))
+AXON_BREAKER_THRESHOLD=int(os.environ.get('AXOP_AXON_BREAKER_THRESHOLD', '5'))
+AXON_BREAKER_COOLDOWN=int(os.environ.get('AXOP_AXON_BREAKER_COOLDOWN', '30'))
+
+# Contexts reconciled in parallel (per instance)
+AXON_CONTEXTS_CONCURRENCY=int(os.environ.get('AXOP_AXON_CONTEXTS_CONCURRENCY', '10'))
+
+# Vault timeouts (seconds, bounded by the handler deadline)
+VAULT_CONNECT_TIMEOUT=float(os.environ.get('AXOP_VAULT_CONNECT_TIMEOUT', '5'))
+VAULT_READ_TIMEOUT=float(os.environ.get('AXOP_VAULT_READ_TIMEOUT', '30'))
+
+# Vault secrets cache (seconds before checking the secret version)
+VAULT_SECRET_TTL=int(os.environ.get('AXOP_VAULT_SECRET_TTL', '60'))
+
+# Vault secrets read in parallel when rendering a payload
+VAULT_CONCURRENCY=int(os.environ.get('AXOP_VAULT_CONCURRENCY', '8'))
+
+# Drift detection between Axon Server and objects (seconds, 0 to disable)
+DRIFT_INTERVAL=int(os.environ.get('AXOP_DRIFT_INTERVAL', str(10*60)))
+DRIFT_JITTER=int(os.environ.get('AXOP_DRIFT_JITTER', '60'))
+
+# Kubernetes API client (connections shared by all handlers)
+KUBE_POOL_SIZE=int(os.environ.get('AXOP_KUBE_POOL_SIZE', '16'))
@@ -19,10 +19,12 @@ Metadata definition
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Optional
+from typing import Dict, Optional
 from pydantic import BaseModel # pylint: disable=no-name-in-module
 
 class Metadata(BaseModel): # pylint: disable=too-few-public-methods
     """Kubernetes Metadata model"""
     namespace: Optional[str] # Optional for Cluster scope
     name: str
+    uid: Optional[str]
+    labels: Optional[Dict[str, str]]
@@ -19,7 +19,7 @@ Plugins Kind
 # You should have received a copy of the GNU Lesser General Public License
 # along with axop.  If not, see <https://www.gnu.org/licenses/>.
 
-from typing import Literal, List
+from typing import Literal, List, Optional
 from pydantic import BaseModel # pylint: disable=no-name-in-module
 from .metadata import Metadata
 
@@ -28,9 +28,17 @@ class TemplateSpec(BaseModel): # pylint: disable=too-few-public-methods
     payload: str
     variables: List[str]
 
+class RolloutSpec(BaseModel): # pylint: disable=too-few-public-methods
+    """Rollout of a template change to the contexts using the plugin"""
+    waveSize: int = 10
+    concurrency: Optional[int] # AXOP_DEPENDENTS_CONCURRENCY by default
+    maxErrorRate: float = 0.1
+    paused: bool = False
+
 class PluginSpec(BaseModel): # pylint: disable=too-few-public-methods
     """Plugin Spec model"""
     template: TemplateSpec
+    rollout: Optional[RolloutSpec]
 
 class PluginKind(BaseModel): # pylint: disable=too-few-public-methods
     """Plugin Kind model"""
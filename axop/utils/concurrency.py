@@ -0,0 +1,59 @@
+"""
+Concurrency helpers
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+from typing import Awaitable, Dict, Iterable, List
+
+class KeyedSemaphores(): # pylint: disable=too-few-public-methods
+    """
+    Semaphores created on demand and shared per key (eg: instance name)
+    """
+
+    def __init__(self, limit: int):
+        self._limit = limit
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+
+    def get(self, key: str) -> asyncio.Semaphore:
+        """Get the semaphore associated to the key"""
+        semaphore = self._semaphores.get(key)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self._limit)
+            self._semaphores[key] = semaphore
+
+        return semaphore
+
+async def gather_bounded(semaphore: asyncio.Semaphore, aws: Iterable[Awaitable]) -> List:
+    """
+    Run awaitables concurrently, never more than the semaphore allows at the same time
+
+    All awaitables are completed even if some of them fail. The first error is raised.
+    """
+    async def bounded(aw: Awaitable):
+        async with semaphore:
+            return await aw
+
+    results = await asyncio.gather(*[bounded(aw) for aw in aws], return_exceptions=True)
+
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+
+    return results
@@ -0,0 +1,80 @@
+"""
+Deadline propagation (remaining time budget of a handler)
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import contextlib
+import contextvars
+import datetime
+import functools
+import time
+from typing import Callable, Iterator, Optional
+
+class DeadlineExceeded(Exception):
+    """The time budget of the handler is exhausted"""
+
+_deadline: contextvars.ContextVar[Optional[float]] = \
+    contextvars.ContextVar("axop_deadline", default=None)
+
+@contextlib.contextmanager
+def deadline(seconds: float) -> Iterator[None]:
+    """
+    Set the time budget for the current task (and threads started with its context)
+    """
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+def remaining() -> Optional[float]:
+    """Remaining time before the deadline (None if there is no deadline)"""
+    value = _deadline.get()
+    if value is None:
+        return None
+
+    return value - time.monotonic()
+
+def timeout(seconds: float) -> float:
+    """
+    Timeout for an I/O bounded by the deadline
+
+    Raise DeadlineExceeded if the deadline is already reached
+    """
+    left = remaining()
+    if left is None:
+        return seconds
+    if left <= 0:
+        raise DeadlineExceeded("Deadline exceeded")
+
+    return min(seconds, left)
+
+def handler_deadline(seconds: float) -> Callable:
+    """
+    Decorator for kopf async handlers: the deadline is the handler timeout minus its runtime
+    """
+    def decorator(fn: Callable) -> Callable:
+        @functools.wraps(fn)
+        async def wrapper(*args, runtime: datetime.timedelta = datetime.timedelta(0), **kwargs):
+            with deadline(seconds - runtime.total_seconds()):
+                return await fn(*args, runtime=runtime, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,31 @@
+"""
+Content fingerprints
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import hashlib
+import json
+from typing import Any
+
+def fingerprint(*values: Any) -> str:
+    """
+    Stable short hash of json compatible values (dict keys order does not matter)
+    """
+    content = json.dumps(values, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(content.encode(encoding='UTF-8')).hexdigest()[:16]
@@ -0,0 +1,198 @@
+"""
+Precompiled YAML payload templates
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import re
+import string
+import uuid
+from typing import Any, Dict, List, Optional, Union
+import yaml
+
+class TemplateError(ValueError):
+    """Invalid payload template"""
+
+_resolver = yaml.resolver.Resolver()
+_constructor = yaml.constructor.SafeConstructor()
+
+def _implicit(value: str) -> Any:
+    """Type a plain YAML scalar (int, float, bool, null, ...) without parsing a document"""
+    tag = _resolver.resolve(yaml.ScalarNode, value, (True, False))
+    if tag == _resolver.DEFAULT_SCALAR_TAG:
+        return value
+
+    return _constructor.yaml_constructors[tag](_constructor, yaml.ScalarNode(tag, value))
+
+# plain text read as one scalar (no flow collection, comment, quote, anchor, ...)
+_SIMPLE = re.compile(r"(?![-?:](\s|$))[^\s\[\]{}#&*!|>'\"%@`,]([^\n]*[^\s:])?")
+
+def _plain(value: str) -> Any:
+    """Value of a plain scalar, like YAML reads it in the payload (eg: [1, 2] is a list)"""
+    if _SIMPLE.fullmatch(value) and ": " not in value and " #" not in value:
+        return _implicit(value)
+
+    try:
+        node = yaml.compose(value, Loader=yaml.SafeLoader)
+        if isinstance(node, yaml.CollectionNode) and not node.flow_style:
+            raise TemplateError(f"Invalid value {value!r}: block collection in a scalar")
+        return yaml.safe_load(value)
+    except yaml.YAMLError as e:
+        raise TemplateError(f"Invalid value {value!r}: {e}") from e
+
+class _Scalar(): # pylint: disable=too-few-public-methods
+    """Scalar with placeholders"""
+    def __init__(self, parts: List[Union[str, int]], names: List[str], plain: bool):
+        # str parts are kept as is, int parts are index of names
+        self.parts = parts
+        self.names = names
+        self.plain = plain
+
+    def render(self, values: Dict[str, Any]) -> Any:
+        """Replace placeholders"""
+        if len(self.parts) == 1 and isinstance(self.parts[0], int):
+            value = values[self.names[self.parts[0]]]
+            if not self.plain:
+                return str(value)
+            if isinstance(value, (dict, list)):
+                return _copy(value)
+            return _plain(str(value))
+
+        result = "".join(
+            part if isinstance(part, str) else str(values[self.names[part]])
+            for part in self.parts
+        )
+
+        return _plain(result) if self.plain else result
+
+def _copy(value: Any) -> Any:
+    """Copy dict and list (scalars are immutables)"""
+    if isinstance(value, dict):
+        return {k: _copy(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_copy(v) for v in value]
+    return value
+
+def _render(node: Any, values: Dict[str, Any]) -> Any:
+    if isinstance(node, _Scalar):
+        return node.render(values)
+    if isinstance(node, dict):
+        return {_render(k, values): _render(v, values) for k, v in node.items()}
+    if isinstance(node, list):
+        return [_render(v, values) for v in node]
+    return node
+
+class PayloadTemplate(): # pylint: disable=too-few-public-methods
+    """
+    YAML payload using str.format placeholders (eg: {context}) parsed once
+
+    Placeholders are replaced in the parsed document so rendering does not parse YAML.
+    A plain (unquoted) placeholder is typed like YAML does (int, bool, list, ...).
+    A template that is only a YAML document once rendered (eg: a placeholder for
+    a whole line) is rendered as text.
+    """
+
+    def __init__(self, payload: str, variables: List[str]):
+        self._payload = payload
+        self._tree: Any = None
+        # templates using conversion or format spec (eg: {var!r}) are rendered as text
+        self._text_only = False
+
+        self._compile(variables)
+
+    def _compile(self, variables: List[str]): # pylint: disable=too-many-locals
+        try:
+            fields = [i for i in string.Formatter().parse(self._payload) if i[1] is not None]
+        except ValueError as e:
+            raise TemplateError(f"Invalid template: {e}") from e
+
+        for _, name, format_spec, conversion in fields:
+            if name not in variables:
+                raise TemplateError(f"Invalid template: '{name}' is not declared in variables")
+            if format_spec or conversion:
+                self._text_only = True
+
+        if self._text_only:
+            return
+
+        # Each placeholder occurrence is replaced by a unique token
+        prefix = f"axop{uuid.uuid4().hex}o"
+        names: List[str] = []
+
+        class Occurrences(dict):
+            """Unique token for each placeholder"""
+            def __missing__(self, key):
+                names.append(key)
+                return f"{prefix}{len(names) - 1}x"
+
+        try:
+            document = self._payload.format_map(Occurrences())
+            root = yaml.compose(document, Loader=yaml.SafeLoader)
+            data = yaml.safe_load(document)
+        except yaml.YAMLError:
+            # placeholders are not scalars (eg: {block} line): checked on render
+            self._text_only = True
+            return
+
+        token = re.compile(f"{prefix}(\\d+)x")
+
+        # occurrence: plain (unquoted) scalar
+        plains: Dict[int, bool] = {}
+        def styles(node: Optional[yaml.Node]):
+            if isinstance(node, yaml.ScalarNode):
+                for match in token.finditer(node.value):
+                    plains[int(match.group(1))] = node.style is None
+            elif isinstance(node, yaml.SequenceNode):
+                for i in node.value:
+                    styles(i)
+            elif isinstance(node, yaml.MappingNode):
+                for k, v in node.value:
+                    styles(k)
+                    styles(v)
+        styles(root)
+
+        def compile_node(node: Any) -> Any:
+            if isinstance(node, str):
+                splitted = token.split(node)
+                if len(splitted) == 1:
+                    return node
+                # split returns [text, index, text, index, ..., text]
+                parts: List[Union[str, int]] = [
+                    int(part) if i % 2 == 1 else part
+                    for i, part in enumerate(splitted)
+                    if i % 2 == 1 or part != ""
+                ]
+                plain = plains.get(int(splitted[1]), False)
+                return _Scalar(parts, names, plain)
+            if isinstance(node, dict):
+                return {compile_node(k): compile_node(v) for k, v in node.items()}
+            if isinstance(node, list):
+                return [compile_node(v) for v in node]
+            return node
+
+        self._tree = compile_node(data)
+
+    def render(self, values: Dict[str, Any]) -> Any:
+        """Render the payload with values"""
+        if self._text_only:
+            try:
+                return yaml.safe_load(self._payload.format(**values))
+            except yaml.YAMLError as e:
+                raise TemplateError(f"Invalid payload: {e}") from e
+
+        return _render(self._tree, values)
@@ -0,0 +1,85 @@
+"""
+Waiters: handlers blocked until an object is indexed
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import asyncio
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+class Waiters():
+    """
+    Handlers waiting for an object (per key, eg: instance name)
+
+    Index functions notify the waiters with the object as soon as it is indexed.
+    They can run in a thread (sync handlers): waiters are woken up in their loop.
+    """
+
+    def __init__(self):
+        self._waiters: Dict[str, List[Tuple[asyncio.AbstractEventLoop, asyncio.Future]]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(i) for i in self._waiters.values())
+
+    async def wait(self, key: str, lookup: Callable[[], Optional[Any]],
+        timeout: float) -> Optional[Any]:
+        """
+        Get the object with lookup or wait for a notification (None on timeout)
+        """
+        value = lookup()
+        if value is not None or timeout <= 0:
+            return value
+
+        loop = asyncio.get_running_loop()
+        waiter = (loop, loop.create_future())
+
+        with self._lock:
+            self._waiters.setdefault(key, []).append(waiter)
+
+        try:
+            # indexed between the lookup and the registration
+            value = lookup()
+            if value is not None:
+                return value
+
+            return await asyncio.wait_for(waiter[1], timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(key, [])
+                if waiter in waiters:
+                    waiters.remove(waiter)
+                if len(waiters) == 0:
+                    self._waiters.pop(key, None)
+
+    def notify(self, key: str, value: Any):
+        """Wake up the waiters of the key with the object"""
+        with self._lock:
+            waiters = self._waiters.pop(key, [])
+
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(Waiters._set_result, future, value)
+
+    @staticmethod
+    def _set_result(future: asyncio.Future, value: Any):
+        if not future.done():
+            future.set_result(value)
@@ -0,0 +1,956 @@
+"""
+Load harness: the real App and Context handlers against a fake Axon Server, vault and kubernetes
+
+Everything runs in-process on localhost (no cluster, no network):
+
+    python benchmarks/load.py [--apps 5000] [--contexts 500] [--axon-latency 0.01]
+        [--axon-error-rate 0.01]
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import asyncio
+import collections
+import copy
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# the fake vault is reached with the address of the specs and a static token
+os.environ.pop("VAULT_ADDR", None)
+os.environ.setdefault("VAULT_TOKEN", "load-test")
+
+# pylint: disable=wrong-import-position
+import kopf
+import kubernetes
+import prometheus_client
+from kopf._core.actions import execution
+from kopf._core.engines.indexing import Index
+from kopf._core.intents import causes
+from axop import apps, contexts, instances, plugins, settings
+from axop.axon.pool import sessions as axon_sessions
+from axop.kube import kube
+
+logger = logging.getLogger("axop.load")
+
+def percentile(values: List[float], ratio: float) -> float:
+    """Nearest-rank percentile"""
+    if len(values) == 0:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(ratio * len(ordered)))]
+
+def merge(target: dict, patch: dict):
+    """Apply a merge patch (None deletes)"""
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        elif isinstance(value, dict) and isinstance(target.get(key), dict):
+            merge(target[key], value)
+        else:
+            target[key] = copy.deepcopy(value)
+
+async def start_site(app: web.Application) -> Tuple[web.AppRunner, str]:
+    """Serve an aiohttp application on a random local port"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+class Latency(): # pylint: disable=too-few-public-methods
+    """Injected latency and errors"""
+    def __init__(self, latency: float, jitter: float = 0.0, error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    def delay(self) -> float:
+        """Latency of one request"""
+        return max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+
+    def fail(self) -> bool:
+        """Whether this request fails"""
+        return random.random() < self.error_rate
+
+class FakeAxonServer(): # pylint: disable=too-many-instance-attributes
+    """
+    Axon Server admin API stand-in (contexts, plugins and applications) keeping its state in memory
+    """
+
+    def __init__(self, latency: Latency, concurrency: int = 0):
+        self.latency = latency
+        self.contexts: Dict[str, str] = {}
+        self.applications: Dict[str, dict] = {}
+        # (context, name, version): active
+        self.plugins: Dict[Tuple[str, str, str], bool] = {}
+        self.requests: collections.Counter = collections.Counter()
+        self.errors = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._capacity = asyncio.Semaphore(concurrency) if concurrency > 0 else None
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.router.add_post("/v1/context", self.post_context)
+        self.app.router.add_get("/v1/public/context", self.get_contexts)
+        self.app.router.add_post("/v1/plugins/configuration", self.post_plugin_configuration)
+        self.app.router.add_post("/v1/plugins/status", self.post_plugin_status)
+        self.app.router.add_delete("/v1/plugins/context", self.delete_plugin)
+        self.app.router.add_get("/v1/plugins", self.get_plugins)
+        self.app.router.add_post("/v1/applications", self.post_application)
+        self.app.router.add_get("/v1/applications", self.get_applications)
+        self.app.router.add_delete("/v1/applications/{name}", self.delete_application)
+
+    async def start(self):
+        """Start serving"""
+        self._runner, self.url = await start_site(self.app)
+
+    async def stop(self):
+        """Stop serving"""
+        await self._runner.cleanup()
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler: Callable) -> web.StreamResponse:
+        self.requests[f"{request.method} {request.match_info.route.resource.canonical}"] += 1
+
+        if self._capacity is not None:
+            await self._capacity.acquire()
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        try:
+            await asyncio.sleep(self.latency.delay())
+            if self.latency.fail():
+                self.errors += 1
+                return web.Response(status=503, text="injected error")
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+            if self._capacity is not None:
+                self._capacity.release()
+
+    async def post_context(self, request: web.Request) -> web.Response:
+        """Create a context"""
+        body = await request.json()
+        if body["context"] in self.contexts:
+            return web.Response(status=400, text="[AXONIQ-1304] Context already exists")
+        self.contexts[body["context"]] = body.get("replicationGroup", "")
+        return web.Response(text="")
+
+    async def get_contexts(self, _: web.Request) -> web.Response:
+        """List contexts"""
+        return web.json_response([
+            {"context": context, "replicationGroup": group}
+            for context, group in self.contexts.items()
+        ])
+
+    async def post_plugin_configuration(self, request: web.Request) -> web.Response:
+        """Configure a plugin for a context"""
+        body = await request.json()
+        self.plugins.setdefault((body["context"], body["name"], str(body["version"])), False)
+        return web.Response(text="")
+
+    async def post_plugin_status(self, request: web.Request) -> web.Response:
+        """Activate or deactivate a plugin for a context"""
+        query = request.query
+        self.plugins[(query["targetContext"], query["name"], query["version"])] = \
+            query["active"] == "True"
+        return web.Response(text="")
+
+    async def delete_plugin(self, request: web.Request) -> web.Response:
+        """Remove a plugin configuration from a context"""
+        query = request.query
+        self.plugins.pop((query["targetContext"], query["name"], query["version"]), None)
+        return web.Response(text="")
+
+    async def get_plugins(self, _: web.Request) -> web.Response:
+        """List plugins with their status per context"""
+        grouped: Dict[Tuple[str, str], List[dict]] = collections.defaultdict(list)
+        for (context, name, version), active in self.plugins.items():
+            grouped[(name, version)].append({"context": context, "active": active})
+
+        return web.json_response([
+            {"name": name, "version": version, "contextInfo": info}
+            for (name, version), info in grouped.items()
+        ])
+
+    async def post_application(self, request: web.Request) -> web.Response:
+        """Register or update an application (token returned on creation)"""
+        body = await request.json()
+        if body["name"] in self.applications:
+            self.applications[body["name"]].update(roles=body["roles"])
+            return web.Response(text="")
+
+        self.applications[body["name"]] = body
+        return web.Response(text=f"token-{body['name']}")
+
+    async def get_applications(self, _: web.Request) -> web.Response:
+        """List applications"""
+        return web.json_response(list(self.applications.values()))
+
+    async def delete_application(self, request: web.Request) -> web.Response:
+        """Unregister an application"""
+        if self.applications.pop(request.match_info["name"], None) is None:
+            return web.Response(status=404, text="not found")
+        return web.Response(text="")
+
+class FakeVault():
+    """
+    HashiCorp Vault stand-in: kubernetes auth, token lookup and KV v2 secrets
+    """
+
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        # (mount, path): versions
+        self.secrets: Dict[Tuple[str, str], List[dict]] = {}
+        self.requests: collections.Counter = collections.Counter()
+        self._runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+        self.app = web.Application(middlewares=[self._middleware])
+        self.app.router.add_post("/v1/auth/{auth}/login", self.login)
+        self.app.router.add_get("/v1/auth/token/lookup-self", self.lookup_self)
+        self.app.router.add_post("/v1/auth/token/renew-self", self.login)
+        self.app.router.add_get("/v1/{mount}/data/{path:.*}", self.read_secret)
+        self.app.router.add_get("/v1/{mount}/metadata/{path:.*}", self.read_metadata)
+
+    async def start(self):
+        """Start serving"""
+        self._runner, self.url = await start_site(self.app)
+
+    async def stop(self):
+        """Stop serving"""
+        await self._runner.cleanup()
+
+    def write(self, mount: str, path: str, data: dict):
+        """Write a new version of a secret"""
+        self.secrets.setdefault((mount, path), []).append(data)
+
+    @web.middleware
+    async def _middleware(self, request: web.Request, handler: Callable) -> web.StreamResponse:
+        self.requests[request.match_info.route.resource.canonical] += 1
+        await asyncio.sleep(self.latency.delay())
+        if self.latency.fail():
+            return web.json_response({"errors": ["injected error"]}, status=503)
+        return await handler(request)
+
+    async def login(self, _: web.Request) -> web.Response:
+        """Kubernetes login or token renewal"""
+        return web.json_response({
+            "auth": {"client_token": "load-test", "lease_duration": 3600, "renewable": True}
+        })
+
+    async def lookup_self(self, _: web.Request) -> web.Response:
+        """Token lookup (authentication check)"""
+        return web.json_response({"data": {"id": "load-test"}})
+
+    async def read_secret(self, request: web.Request) -> web.Response:
+        """Read the last version of a secret"""
+        versions = self.secrets.get((request.match_info["mount"], request.match_info["path"]))
+        if not versions:
+            return web.json_response({"errors": []}, status=404)
+        return web.json_response({
+            "data": {"data": versions[-1], "metadata": {"version": len(versions)}}
+        })
+
+    async def read_metadata(self, request: web.Request) -> web.Response:
+        """Read the metadata of a secret"""
+        versions = self.secrets.get((request.match_info["mount"], request.match_info["path"]))
+        if not versions:
+            return web.json_response({"errors": []}, status=404)
+        return web.json_response({"data": {"current_version": len(versions)}})
+
+class FakeCoreV1Api():
+    """
+    kubernetes CoreV1Api stand-in for the binding secrets (synchronous, like the real client)
+    """
+
+    latency = Latency(0.0)
+    secrets: Dict[Tuple[str, str], dict] = {}
+    lock = threading.Lock()
+
+    def __init__(self, api_client=None):
+        self.api_client = api_client
+
+    @classmethod
+    def _call(cls):
+        time.sleep(cls.latency.delay())
+        if cls.latency.fail():
+            raise kubernetes.client.ApiException(status=503, reason="injected error")
+
+    def create_namespaced_secret(self, namespace: str, body: Any, **_) -> dict:
+        """Create a secret (409 if it already exists)"""
+        self._call()
+        body = body if isinstance(body, dict) else self.api_client.sanitize_for_serialization(body)
+        key = (namespace, body["metadata"]["name"])
+        with self.lock:
+            if key in self.secrets:
+                raise kubernetes.client.ApiException(status=409, reason="AlreadyExists")
+            self.secrets[key] = copy.deepcopy(body)
+        return body
+
+    def patch_namespaced_secret(self, name: str, namespace: str, body: Any, **kwargs) -> dict:
+        """Patch a secret (404 if it does not exist unless server-side apply)"""
+        self._call()
+        body = body if isinstance(body, dict) else self.api_client.sanitize_for_serialization(body)
+        apply = kwargs.get("_content_type") == "application/apply-patch+yaml"
+        with self.lock:
+            secret = self.secrets.get((namespace, name))
+            if secret is None:
+                if not apply:
+                    raise kubernetes.client.ApiException(status=404, reason="NotFound")
+                secret = self.secrets[(namespace, name)] = {}
+            merge(secret, body)
+        return secret
+
+    def read_namespaced_secret(self, name: str, namespace: str,
+        **_) -> kubernetes.client.V1Secret:
+        """Read a secret (404 if it does not exist)"""
+        self._call()
+        with self.lock:
+            secret = copy.deepcopy(self.secrets.get((namespace, name)))
+        if secret is None:
+            raise kubernetes.client.ApiException(status=404, reason="NotFound")
+        return kubernetes.client.V1Secret(data=secret.get("data"), type=secret.get("type"))
+
+    def delete_namespaced_secret(self, name: str, namespace: str, **_):
+        """Delete a secret"""
+        self._call()
+        with self.lock:
+            self.secrets.pop((namespace, name), None)
+
+class FakeCustomObjectsApi(): # pylint: disable=too-few-public-methods
+    """
+    kubernetes CustomObjectsApi stand-in: patches (status checkpoints) are merged into the objects
+    """
+
+    objects: Dict[Tuple[str, str, str], dict] = {}
+    patches = 0
+
+    def __init__(self, api_client=None):
+        self.api_client = api_client
+
+    def patch_namespaced_custom_object(self, group: str, version: str, namespace: str, # pylint: disable=too-many-arguments
+        plural: str, name: str, body: dict, **_) -> dict:
+        """Merge patch an object"""
+        del group, version
+        FakeCoreV1Api._call() # pylint: disable=protected-access
+        with FakeCoreV1Api.lock:
+            raw = self.objects.get((plural, namespace, name))
+            if raw is None:
+                raise kubernetes.client.ApiException(status=404, reason="NotFound")
+            merge(raw, body)
+            FakeCustomObjectsApi.patches += 1
+        return raw
+
+PLUGIN_PAYLOAD = """
+context: '{context}'
+name: io.axoniq.axon-server-plugin-data-protection-azure
+version: '{version}'
+properties:
+  'MetaModel configuration':
+    metamodel: '{model}'
+  'Azure Vault Configuration':
+    prefix: '{context}'
+    azureVaultUrl: 'https://{env}-myvault.vault.azure.net'
+    azureServicePrincipalClientId:
+      hashicorpVault:
+        addr: VAULT_URL
+        role: axoniq-operator
+        auth: kubernetes
+        path: teams/devops/axoniq/keyvault/{env}
+        mount: secret
+        field: clientid
+    azureServicePrincipalSecret:
+      hashicorpVault:
+        addr: VAULT_URL
+        role: axoniq-operator
+        auth: kubernetes
+        path: teams/devops/axoniq/keyvault/{env}
+        mount: secret
+        field: secret
+"""
+
+ENVS = ("dev", "prod")
+
+class Workload():
+    """Custom resources of the load test"""
+
+    def __init__(self, args: argparse.Namespace, axons: List[FakeAxonServer], vault: FakeVault):
+        self.instances = [
+            {
+                "apiVersion": f"{settings.GROUP}/{settings.LATEST_VERSION}",
+                "kind": "Instance",
+                "metadata": {"name": f"instance-{i}"},
+                "spec": {
+                    "http": axon.url,
+                    "grpc": f"axonserver-{i}:8124",
+                    "token": {"hashicorpVault": {
+                        "addr": vault.url, "role": "axoniq-operator", "auth": "kubernetes",
+                        "path": f"teams/devops/axoniq/instance-{i}", "mount": "secret",
+                        "field": "token"
+                    }}
+                }
+            }
+            for i, axon in enumerate(axons)
+        ]
+
+        self.plugins = [
+            {
+                "apiVersion": f"{settings.GROUP}/{settings.LATEST_VERSION}",
+                "kind": "Plugin",
+                "metadata": {"name": f"plugin-{i}"},
+                "spec": {"template": {
+                    "payload": PLUGIN_PAYLOAD.replace("VAULT_URL", vault.url),
+                    "variables": ["context", "version", "model", "env"]
+                }}
+            }
+            for i in range(args.plugins)
+        ]
+
+        # Context objects (contexts are named after their object)
+        self.contexts = {
+            f"contexts-{i}": {
+                "apiVersion": f"{settings.GROUP}/{settings.LATEST_VERSION}",
+                "kind": "Context",
+                "metadata": {
+                    "name": f"contexts-{i}", "namespace": f"ns-{i % 50}",
+                    "uid": f"uid-contexts-{i}", "generation": 1
+                },
+                "spec": {
+                    "instance": f"instance-{i % len(axons)}",
+                    "contexts": [
+                        {
+                            "context": f"context-{i}-{j}",
+                            "plugins": {
+                                plugin["metadata"]["name"]: {
+                                    "version": "1.0.0", "model": "{}", "env": ENVS[j % 2]
+                                }
+                                for plugin in self.plugins
+                            }
+                        }
+                        for j in range(args.contexts_per_cr)
+                    ]
+                }
+            }
+            for i in range(args.contexts)
+        }
+
+        self.apps = {
+            f"app-{i}": {
+                "apiVersion": f"{settings.GROUP}/{settings.LATEST_VERSION}",
+                "kind": "App",
+                "metadata": {
+                    "name": f"app-{i}", "namespace": f"ns-{i % 50}",
+                    "uid": f"uid-app-{i}", "generation": 1
+                },
+                "spec": {
+                    "instance": f"instance-{i % len(axons)}",
+                    "description": f"application {i}",
+                    "contexts": [
+                        {
+                            "context": f"context-{(i + j) % max(1, args.contexts)}-0",
+                            "roles": ["READ", "WRITE"]
+                        }
+                        for j in range(args.app_contexts)
+                    ]
+                }
+            }
+            for i in range(args.apps)
+        }
+
+        for instance in self.instances:
+            vault.write("secret", instance["spec"]["token"]["hashicorpVault"]["path"],
+                {"token": "axon-token"})
+        for env in ENVS:
+            vault.write("secret", f"teams/devops/axoniq/keyvault/{env}",
+                {"clientid": f"client-{env}", "secret": f"secret-{env}"})
+
+        FakeCustomObjectsApi.objects = {
+            (plural, raw["metadata"]["namespace"], raw["metadata"]["name"]): raw
+            for plural, objects in ((contexts.CONTEXTS, self.contexts), (apps.APPS, self.apps))
+            for raw in objects.values()
+        }
+
+        self.indices = {
+            "instances_idx": self._index(instances.instances_idx, self.instances),
+            "plugins_idx": self._index(plugins.plugins_idx, self.plugins),
+            "contexts_idx": self._index(contexts.contexts_idx, self.contexts.values()),
+            "apps_idx": self._index(apps.apps_idx, self.apps.values())
+        }
+
+    @classmethod
+    def _index(cls, indexer: Callable, objects) -> Index:
+        """Fill an index like kopf does with the indexing function of the operator"""
+        index: Index = Index()
+        for raw in objects:
+            cls._reindex(index, indexer, raw)
+        return index
+
+    @classmethod
+    def _reindex(cls, index: Index, indexer: Callable, raw: dict):
+        """Index an object with the indexing function of the operator"""
+        # pylint: disable=protected-access
+        index._replace((raw["metadata"].get("namespace"), raw["metadata"]["name"], None),
+            indexer(body=kopf.Body(raw)))
+
+    def reindex(self, kind: str, raw: dict):
+        """
+        Index the latest version of an object
+
+        kopf indexes an object in its own worker, right before its handlers: a
+        change received while a handler is running is not indexed before it ends.
+        """
+        if kind == apps.APPS:
+            self._reindex(self.indices["apps_idx"], apps.apps_idx, raw)
+        else:
+            self._reindex(self.indices["contexts_idx"], contexts.contexts_idx, raw)
+
+    def update(self, kind: str, name: str) -> dict:
+        """Change an object (new generation) and return its previous version"""
+        raw = self.apps[name] if kind == apps.APPS else self.contexts[name]
+        old = copy.deepcopy(raw)
+
+        raw["metadata"]["generation"] += 1
+        if kind == apps.APPS:
+            contexts_roles = raw["spec"]["contexts"]
+            contexts_roles[0]["roles"] = ["READ"] if "WRITE" in contexts_roles[0]["roles"] \
+                else ["READ", "WRITE"]
+        else:
+            for plugin in raw["spec"]["contexts"][0]["plugins"].values():
+                plugin["model"] = json.dumps({"generation": raw["metadata"]["generation"]})
+
+        return old
+
+class Event(): # pylint: disable=too-few-public-methods
+    """A resource change waiting for its handler"""
+    def __init__(self, kind: str, action: str, name: str, old: Optional[dict] = None):
+        self.kind = kind
+        self.action = action
+        self.name = name
+        self.old = old
+        self.attempts = 0
+        self.enqueued = time.monotonic()
+
+    @property
+    def key(self) -> str:
+        """Handler name"""
+        return f"{self.kind}/{self.action}"
+
+HANDLERS = {
+    f"{apps.APPS}/create": apps.app_register,
+    f"{apps.APPS}/update": apps.app_update,
+    f"{apps.APPS}/delete": apps.app_unregister,
+    f"{contexts.CONTEXTS}/create": contexts.ctx_create,
+    f"{contexts.CONTEXTS}/update": contexts.ctx_update,
+}
+
+class Stats(): # pylint: disable=too-few-public-methods
+    """Results of one handler"""
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.durations: List[float] = []
+        self.retries = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.errors: collections.Counter = collections.Counter()
+
+class Runner(): # pylint: disable=too-many-instance-attributes
+    """
+    Dispatch events to the operator handlers like kopf (one worker per object, retries)
+
+    Events of an object are handled one at a time: the ones received while a
+    handler is running (or waiting for a retry) are handled once, with the latest
+    object diffed against the last handled one. An update without spec change
+    since the last handled object does not call the handler.
+    """
+
+    def __init__(self, args: argparse.Namespace, workload: Workload):
+        self.args = args
+        self.workload = workload
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.stats: Dict[str, Stats] = collections.defaultdict(Stats)
+        self.pending = 0
+        self.running = 0
+        self.samples: List[Tuple[int, int, int]] = []
+        self._done = asyncio.Event()
+        self._tasks: List[asyncio.Task] = []
+        # object (kind, name): event being handled, events received meanwhile
+        self._owners: Dict[Tuple[str, str], Event] = {}
+        self._backlogs: Dict[Tuple[str, str], List[Event]] = collections.defaultdict(list)
+        # last handled object (kopf diffbase)
+        self._handled: Dict[Tuple[str, str], dict] = {}
+
+    def submit(self, event: Event):
+        """Enqueue an event"""
+        self.pending += 1
+        self._done.clear()
+        self.queue.put_nowait(event)
+
+    def _raw(self, event: Event) -> dict:
+        return self.workload.apps[event.name] if event.kind == apps.APPS \
+            else self.workload.contexts[event.name]
+
+    def _acquire(self, event: Event) -> bool:
+        """Take the worker of the object (False: queued until the running handler ends)"""
+        key = (event.kind, event.name)
+        owner = self._owners.get(key)
+
+        if owner is not None and owner is not event:
+            self._backlogs[key].append(event)
+            return False
+
+        self._owners[key] = event
+        return True
+
+    def _coalesce(self, event: Event, backlog: List[Event]) -> List[Event]:
+        """Events handled by the event (same action): the others are kept"""
+        kept = []
+        for i in backlog:
+            if i.action == event.action:
+                self._finish(i, coalesced=True)
+            else:
+                kept.append(i)
+        return kept
+
+    def _release(self, event: Event):
+        """Free the worker of the object and queue the next event"""
+        key = (event.kind, event.name)
+        del self._owners[key]
+
+        backlog = self._backlogs.pop(key, [])
+        if len(backlog) > 0:
+            latest = backlog[-1]
+            for i in self._coalesce(latest, backlog[:-1]) + [latest]:
+                self.queue.put_nowait(i)
+
+    def _finish(self, event: Event, coalesced: bool = False):
+        stats = self.stats[event.key]
+        stats.latencies.append(time.monotonic() - event.enqueued)
+        if coalesced:
+            stats.coalesced += 1
+
+        self.pending -= 1
+        if self.pending == 0:
+            self._done.set()
+
+    async def _invoke(self, event: Event, raw: dict, body: kopf.Body):
+        patch = kopf.Patch()
+        handled = self._handled.get((event.kind, event.name), event.old)
+
+        # kopf.adopt() and sub-handlers look for the cause of the handler
+        execution.cause_var.set(causes.ResourceCause(
+            logger=logger, indices=self.workload.indices, memo=kopf.Memo(),
+            resource=kopf.Resource(settings.GROUP, settings.LATEST_VERSION, event.kind),
+            patch=patch, body=body
+        ))
+
+        kwargs: Dict[str, Any] = dict(
+            self.workload.indices,
+            body=body, patch=patch, meta=body.meta, spec=body.spec, status=body.status,
+            name=body.meta.name, namespace=body.meta.namespace, uid=body.meta.uid,
+            logger=logger, memo=kopf.Memo(), retry=event.attempts - 1,
+            old=None if handled is None else kopf.Body(handled),
+            new=body, diff=(), reason=event.action
+        )
+
+        try:
+            result = await HANDLERS[event.key](**kwargs)
+            if result is not None:
+                patch.status[HANDLERS[event.key].__name__] = result
+        finally:
+            # kopf applies the patch even when the handler fails
+            with FakeCoreV1Api.lock:
+                merge(raw, dict(patch))
+
+    async def _run(self, event: Event):
+        if not self._acquire(event):
+            return
+
+        key = (event.kind, event.name)
+        raw = self._raw(event)
+
+        # the worker indexes the latest object then runs the handlers with it
+        with FakeCoreV1Api.lock:
+            self.workload.reindex(event.kind, raw)
+            snapshot = copy.deepcopy(raw)
+
+        handled = self._handled.get(key)
+        if event.action == "update" and handled is not None and handled["spec"] == snapshot["spec"]:
+            # already handled with a previous event (kopf: no diff, no handler)
+            self._finish(event, coalesced=True)
+            self._release(event)
+            return
+
+        self.running += 1
+        event.attempts += 1
+        stats = self.stats[event.key]
+        started = time.monotonic()
+
+        try:
+            await self._invoke(event, raw, kopf.Body(snapshot))
+        except Exception as e: # pylint: disable=broad-except
+            stats.errors[type(e).__name__] += 1
+            if isinstance(e, kopf.PermanentError) or event.attempts >= self.args.max_attempts:
+                stats.failed += 1
+            else:
+                stats.retries += 1
+                # the retry handles the latest object: events received meanwhile are merged
+                self._backlogs[key] = self._coalesce(event, self._backlogs.get(key, []))
+                delay = getattr(e, "delay", None) or self.args.retry_delay
+                asyncio.get_running_loop().call_later(
+                    min(delay, self.args.retry_delay), self.queue.put_nowait, event
+                )
+                return
+        else:
+            snapshot.pop("status", None)
+            self._handled[key] = snapshot
+        finally:
+            self.running -= 1
+            stats.durations.append(time.monotonic() - started)
+
+        self._finish(event)
+        self._release(event)
+
+    async def _dispatch(self):
+        """No worker limit (kopf default): one task per event"""
+        while True:
+            event = await self.queue.get()
+            task = asyncio.create_task(self._run(event))
+            self._tasks.append(task)
+            task.add_done_callback(self._tasks.remove)
+
+    async def _worker(self):
+        while True:
+            event = await self.queue.get()
+            await self._run(event)
+
+    async def _sample(self):
+        while True:
+            client_queue = sum(
+                prometheus_client.REGISTRY.get_sample_value(
+                    "axop_axon_queue_depth", {"instance": instance["metadata"]["name"]}
+                ) or 0
+                for instance in self.workload.instances
+            )
+            self.samples.append((self.queue.qsize(), self.running, int(client_queue)))
+            await asyncio.sleep(0.1)
+
+    async def phase(self, events: List[Event]) -> float:
+        """Feed the events (at the arrival rate) and wait for all of them"""
+        self.stats.clear()
+        self.samples.clear()
+
+        workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.args.workers)
+        ] if self.args.workers > 0 else [asyncio.create_task(self._dispatch())]
+        sampler = asyncio.create_task(self._sample())
+
+        started = time.monotonic()
+        for event in events:
+            if event.action == "update":
+                # the object changes when the event is sent (previous version kept)
+                event.old = self.workload.update(event.kind, event.name)
+            event.enqueued = time.monotonic()
+            self.submit(event)
+            if self.args.rate > 0:
+                await asyncio.sleep(1 / self.args.rate)
+
+        if self.pending > 0:
+            await self._done.wait()
+        elapsed = time.monotonic() - started
+
+        for task in workers + [sampler]:
+            task.cancel()
+        await asyncio.gather(*workers, sampler, return_exceptions=True)
+
+        return elapsed
+
+def report(phase: str, elapsed: float, runner: Runner, axons: List[FakeAxonServer],
+    vault: FakeVault) -> dict:
+    """Print and return the results of a phase"""
+    events = sum(len(i.latencies) + i.failed for i in runner.stats.values())
+    print(f"\n== {phase}: {events} events in {elapsed:.2f}s ({events / elapsed:.1f}/s)")
+    print(f"{'handler':<20} {'done':>6} {'failed':>6} {'retries':>7} {'merged':>6} {'p50':>8} "
+        f"{'p99':>8} {'max':>8} {'run p50':>8} {'run p99':>8}  errors")
+
+    handlers = {}
+    for key, stats in sorted(runner.stats.items()):
+        handlers[key] = {
+            "done": len(stats.latencies), "failed": stats.failed, "retries": stats.retries,
+            "coalesced": stats.coalesced,
+            "throughput": len(stats.latencies) / elapsed,
+            "p50": percentile(stats.latencies, 0.5), "p99": percentile(stats.latencies, 0.99),
+            "max": max(stats.latencies, default=0.0),
+            "run_p50": percentile(stats.durations, 0.5),
+            "run_p99": percentile(stats.durations, 0.99),
+            "errors": dict(stats.errors)
+        }
+        result = handlers[key]
+        print(f"{key:<20} {result['done']:>6} {result['failed']:>6} {result['retries']:>7} "
+            f"{result['coalesced']:>6} "
+            f"{result['p50']:>7.3f}s {result['p99']:>7.3f}s {result['max']:>7.3f}s "
+            f"{result['run_p50']:>7.3f}s {result['run_p99']:>7.3f}s  "
+            f"{', '.join(f'{k}: {v}' for k, v in stats.errors.items())}")
+
+    samples = runner.samples or [(0, 0, 0)]
+    queues = {
+        "events_queued_max": max(i[0] for i in samples),
+        "handlers_running_max": max(i[1] for i in samples),
+        "handlers_running_mean": sum(i[1] for i in samples) / len(samples),
+        "axon_client_queue_max": max(i[2] for i in samples),
+        "axon_client_queue_mean": sum(i[2] for i in samples) / len(samples)
+    }
+    print("queues: " + ", ".join(
+        f"{k} {v:.1f}" if isinstance(v, float) else f"{k} {v}" for k, v in queues.items()
+    ))
+
+    servers = {
+        "axon_requests": sum(sum(i.requests.values()) for i in axons),
+        "axon_injected_errors": sum(i.errors for i in axons),
+        "axon_max_in_flight": max(i.max_in_flight for i in axons),
+        "vault_requests": sum(vault.requests.values()),
+        "kube_secrets": len(FakeCoreV1Api.secrets),
+        "kube_status_checkpoints": FakeCustomObjectsApi.patches
+    }
+    print("servers: " + ", ".join(f"{k} {v}" for k, v in servers.items()))
+
+    return {"elapsed": elapsed, "events": events, "handlers": handlers,
+        "queues": queues, "servers": servers}
+
+async def main(args: argparse.Namespace) -> dict:
+    """Run the phases"""
+    axons = [
+        FakeAxonServer(
+            Latency(args.axon_latency, args.axon_jitter, args.axon_error_rate),
+            args.axon_concurrency
+        )
+        for _ in range(args.instances)
+    ]
+    vault = FakeVault(Latency(args.vault_latency))
+    FakeCoreV1Api.latency = Latency(args.kube_latency)
+    kubernetes.client.CoreV1Api = FakeCoreV1Api
+    kubernetes.client.CustomObjectsApi = FakeCustomObjectsApi
+    # never reached: requests are served by FakeCoreV1Api
+    kube.configure(kubernetes.client.Configuration())
+
+    for server in axons + [vault]:
+        await server.start()
+
+    workload = Workload(args, axons, vault)
+    runner = Runner(args, workload)
+    results = {}
+
+    try:
+        for phase in args.phases.split(","):
+            if phase == "create":
+                events = [Event(contexts.CONTEXTS, "create", i) for i in workload.contexts] + \
+                    [Event(apps.APPS, "create", i) for i in workload.apps]
+            elif phase == "update":
+                contexts_updated = list(workload.contexts)[
+                    :int(len(workload.contexts) * args.update_ratio)
+                ]
+                apps_updated = list(workload.apps)[:int(len(workload.apps) * args.update_ratio)]
+                events = [
+                    Event(contexts.CONTEXTS, "update", i)
+                    for _ in range(args.update_burst) for i in contexts_updated
+                ] + [
+                    Event(apps.APPS, "update", i)
+                    for _ in range(args.update_burst) for i in apps_updated
+                ]
+            elif phase == "delete":
+                # Context objects have no delete handler
+                events = [Event(apps.APPS, "delete", i) for i in workload.apps]
+            else:
+                raise ValueError(f"unknown phase {phase}")
+
+            random.shuffle(events)
+            elapsed = await runner.phase(events)
+            results[phase] = report(phase, elapsed, runner, axons, vault)
+    finally:
+        await axon_sessions.close()
+        kube.close()
+        for server in axons + [vault]:
+            await server.stop()
+
+    return results
+
+def parse_args() -> argparse.Namespace:
+    """Command line"""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    workload = parser.add_argument_group("workload")
+    workload.add_argument("--apps", type=int, default=5000, help="App objects")
+    workload.add_argument("--app-contexts", type=int, default=2, help="contexts per App")
+    workload.add_argument("--contexts", type=int, default=500, help="Context objects")
+    workload.add_argument("--contexts-per-cr", type=int, default=2,
+        help="contexts per Context object")
+    workload.add_argument("--plugins", type=int, default=1, help="plugins per context")
+    workload.add_argument("--instances", type=int, default=1, help="Axon Server instances")
+    workload.add_argument("--phases", default="create,update",
+        help="comma separated phases: create, update, delete (apps)")
+    workload.add_argument("--update-ratio", type=float, default=0.2,
+        help="objects changed by update")
+    workload.add_argument("--update-burst", type=int, default=1,
+        help="changes per object in the update phase (events of an object are merged by kopf)")
+
+    operator = parser.add_argument_group("operator")
+    operator.add_argument("--rate", type=float, default=0,
+        help="events per second (default 0: all at once)")
+    operator.add_argument("--workers", type=int, default=0,
+        help="handlers running at once (default 0: unlimited like kopf)")
+    operator.add_argument("--max-attempts", type=int, default=5, help="attempts before giving up")
+    operator.add_argument("--retry-delay", type=float, default=1.0,
+        help="maximum delay (seconds) before a retry (kopf would wait the error delay)")
+
+    fakes = parser.add_argument_group("fake servers")
+    fakes.add_argument("--axon-latency", type=float, default=0.01, help="seconds per request")
+    fakes.add_argument("--axon-jitter", type=float, default=0.005, help="+/- seconds per request")
+    fakes.add_argument("--axon-error-rate", type=float, default=0.0, help="ratio of 503 responses")
+    fakes.add_argument("--axon-concurrency", type=int, default=0,
+        help="requests served at once (default 0: unlimited)")
+    fakes.add_argument("--vault-latency", type=float, default=0.005, help="seconds per request")
+    fakes.add_argument("--kube-latency", type=float, default=0.005, help="seconds per request")
+
+    parser.add_argument("--json", help="save results (json)")
+    parser.add_argument("--verbose", action="store_true", help="operator logs")
+
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    logging.basicConfig(level=logging.DEBUG if arguments.verbose else logging.CRITICAL)
+
+    results_all = asyncio.run(main(arguments))
+
+    if arguments.json:
+        Path(arguments.json).write_text(json.dumps(results_all, indent=2), encoding='UTF-8')
@@ -0,0 +1,349 @@
+"""
+Microbenchmarks for the operator CPU hot paths
+
+Run offline (no cluster, no vault, no Axon Server):
+
+    python benchmarks/run.py [--filter diff] [--save baseline.json] [--compare baseline.json]
+"""
+
+# Copyright 2021 Croix Bleue du Québec
+
+# This file is part of axop.
+
+# axop is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# axop is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with axop.  If not, see <https://www.gnu.org/licenses/>.
+
+import argparse
+import copy
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterator, List
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+# pylint: disable=wrong-import-position
+from axop import settings
+from axop.plugins import InternalPlugin, change_reason
+from axop.secrets import vault
+from axop.typing.apps import AppKind
+from axop.typing.contexts import ContextsKind, ContextsSpec
+from axop.typing.plugins import PluginKind
+from axop.utils.template import PayloadTemplate
+
+VAULT_SPEC = {
+    "addr": "https://vault.domain.tld",
+    "role": "axoniq-operator-nonprod",
+    "auth": "kubernetes-nonprod",
+    "mount": "bluecross"
+}
+
+# README example
+PLUGIN = {
+    "apiVersion": "axoniq.bleuelab.ca/v1",
+    "kind": "Plugin",
+    "metadata": {"name": "data-protection"},
+    "spec": {
+        "template": {
+            "payload": """
+context: '{context}'
+name: io.axoniq.axon-server-plugin-data-protection-azure
+version: '{version}'
+properties:
+  'MetaModel configuration':
+    metamodel: '{model}'
+  'Access Control Configuration':
+    allowedReadPrincipals: '{allowedReadPrincipals}'
+  'Azure Vault Configuration':
+    prefix: '{context}'
+    azureVaultUrl: 'https://{env}-myvault.vault.azure.net'
+    azureServicePrincipalClientId:
+      hashicorpVault:
+        addr: https://vault.domain.tld
+        role: axoniq-operator-nonprod
+        auth: kubernetes-nonprod
+        path: teams/devops/axoniq/keyvault/{env}
+        mount: bluecross
+        field: clientid
+    azureServicePrincipalTenantId: 'your tenant id'
+    azureServicePrincipalSecret:
+      hashicorpVault:
+        addr: https://vault.domain.tld
+        role: axoniq-operator-nonprod
+        auth: kubernetes-nonprod
+        path: teams/devops/axoniq/keyvault/{env}
+        mount: bluecross
+        field: secret
+""",
+            "variables": ["context", "version", "allowedReadPrincipals", "model", "env"]
+        }
+    }
+}
+
+PLUGIN_VALUES = {
+    "version": "1.0.1",
+    "allowedReadPrincipals": "app1,app2",
+    "model": '{"config": []}',
+    "env": "dev"
+}
+
+class Benchmark(): # pylint: disable=too-few-public-methods
+    """One benchmark: setup is not measured, run is"""
+    def __init__(self, name: str, size: int, setup: Callable[[], Callable[[], Any]]):
+        self.name = name
+        self.size = size
+        self.setup = setup
+
+    @property
+    def key(self) -> str:
+        """Unique name"""
+        return f"{self.name}[{self.size}]"
+
+def prime_secrets(envs: List[str]):
+    """Fill the secrets cache so rendering never reaches a vault"""
+    settings.VAULT_SECRET_TTL = 10**9
+    for env in envs:
+        # pylint: disable=protected-access
+        vault.secrets._secrets[(VAULT_SPEC["addr"], VAULT_SPEC["mount"],
+            f"teams/devops/axoniq/keyvault/{env}")] = \
+            vault._CachedSecret({"clientid": f"id-{env}", "secret": f"secret-{env}"}, 1)
+
+def contexts_body(size: int, changed_every: int = 0) -> dict:
+    """Context object with size contexts (3 plugins each)"""
+    contexts = []
+    for i in range(size):
+        env = "prod" if changed_every and i % changed_every == 0 else "dev"
+        contexts.append({
+            "context": f"context-{i}",
+            "replicationGroup": "default",
+            "plugins": {
+                f"plugin-{j}": {**PLUGIN_VALUES, "env": env} for j in range(3)
+            }
+        })
+
+    return {
+        "apiVersion": "axoniq.bleuelab.ca/v1",
+        "kind": "Context",
+        "metadata": {"name": "bench", "namespace": "bench", "uid": "uid"},
+        "spec": {"instance": "axonserveree", "contexts": contexts}
+    }
+
+def apps_body(size: int) -> dict:
+    """App object with size contexts"""
+    return {
+        "apiVersion": "axoniq.bleuelab.ca/v1",
+        "kind": "App",
+        "metadata": {"name": "bench", "namespace": "bench", "uid": "uid"},
+        "spec": {
+            "instance": "axonserveree",
+            "description": "bench",
+            "contexts": [
+                {"context": f"context-{i}", "roles": ["READ", "WRITE", "USE_CONTEXT"]}
+                for i in range(size)
+            ]
+        }
+    }
+
+def deep_payload(depth: int, width: int) -> dict:
+    """Payload with secrets at every level"""
+    def level(i: int) -> dict:
+        node: Dict[str, Any] = {
+            f"key-{j}": f"value-{j}" for j in range(width)
+        }
+        node["secret"] = {
+            "hashicorpVault": {
+                **VAULT_SPEC,
+                "path": f"teams/devops/axoniq/keyvault/{'prod' if i % 2 else 'dev'}",
+                "field": "secret"
+            }
+        }
+        if i < depth:
+            node["child"] = level(i + 1)
+        return node
+
+    return level(0)
+
+def benchmarks() -> Iterator[Benchmark]:
+    """All benchmarks"""
+
+    for size in (10, 1000, 10000):
+        def diff_contexts(size=size):
+            current = ContextsKind.parse_obj(contexts_body(size, changed_every=10)).spec
+            previous = ContextsSpec.parse_obj(contexts_body(size)["spec"])
+            return lambda: current.diff_contexts(previous.contexts)
+        yield Benchmark("diff_contexts", size, diff_contexts)
+
+    for size in (10, 1000, 10000):
+        def diff_plugins(size=size):
+            current = ContextsSpec.parse_obj({
+                "instance": "axonserveree",
+                "contexts": [{
+                    "context": "context",
+                    "plugins": {
+                        f"plugin-{i}": {**PLUGIN_VALUES, "env": "prod" if i % 10 == 0 else "dev"}
+                        for i in range(size)
+                    }
+                }]
+            }).contexts[0]
+            previous = {f"plugin-{i}": dict(PLUGIN_VALUES) for i in range(size)}
+            return lambda: current.diff_plugins(previous)
+        yield Benchmark("diff_plugins", size, diff_plugins)
+
+    for size in (10, 100):
+        def diff_rendered(size=size):
+            # ctx_update path: render each plugin and compare with the applied fingerprint
+            prime_secrets(["dev", "prod"])
+            plugin = InternalPlugin(PluginKind.parse_obj(PLUGIN))
+            current = {
+                f"plugin-{i}": {**PLUGIN_VALUES, "env": "prod" if i % 10 == 0 else "dev"}
+                for i in range(size)
+            }
+            applied = {
+                name: plugin.render("context", {**PLUGIN_VALUES, "env": "dev"})[1]
+                for name in current
+            }
+            def run():
+                for name, values in current.items():
+                    _, rendered = plugin.render("context", values)
+                    change_reason(applied[name], rendered)
+            return run
+        yield Benchmark("diff_rendered", size, diff_rendered)
+
+    def template_compile():
+        template = PLUGIN["spec"]["template"]
+        return lambda: PayloadTemplate(template["payload"], template["variables"])
+    yield Benchmark("template_compile", 1, template_compile)
+
+    for size in (1, 100):
+        def get_payload(size=size):
+            prime_secrets(["dev"])
+            plugin = InternalPlugin(PluginKind.parse_obj(PLUGIN))
+            def run():
+                for i in range(size):
+                    plugin.get_payload(f"context-{i}", PLUGIN_VALUES)
+            return run
+        yield Benchmark("get_payload", size, get_payload)
+
+    for depth in (5, 20):
+        def unravel_mysteries(depth=depth):
+            prime_secrets(["dev", "prod"])
+            payload = deep_payload(depth, 10)
+            return lambda: vault.unravel_mysteries(copy.deepcopy(payload))
+        yield Benchmark("unravel_mysteries", depth, unravel_mysteries)
+
+    for size in (10, 1000, 10000):
+        def parse_contexts(size=size):
+            body = contexts_body(size)
+            return lambda: ContextsKind.parse_obj(body)
+        yield Benchmark("parse_contexts", size, parse_contexts)
+
+    for size in (10, 1000, 10000):
+        def parse_apps(size=size):
+            body = apps_body(size)
+            return lambda: AppKind.parse_obj(body)
+        yield Benchmark("parse_apps", size, parse_apps)
+
+def measure(run: Callable[[], Any], min_time: float, max_runs: int) -> Dict[str, float]:
+    """Time a function (at least min_time or max_runs) and its peak memory"""
+    run() # warm up
+
+    timings: List[float] = []
+    started = time.perf_counter()
+    while len(timings) < max_runs and \
+        (time.perf_counter() - started < min_time or len(timings) < 3):
+        before = time.perf_counter()
+        run()
+        timings.append(time.perf_counter() - before)
+
+    tracemalloc.start()
+    run()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        "runs": len(timings),
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.mean(timings),
+        "peak_memory": peak
+    }
+
+def human_time(seconds: float) -> str:
+    """Format a duration"""
+    for unit, factor in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= factor:
+            return f"{seconds / factor:.2f}{unit}"
+    return f"{seconds / 1e-9:.0f}ns"
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict], threshold: float) -> List[str]:
+    """Benchmarks slower than the baseline by more than threshold (ratio)"""
+    regressions = []
+    for key, result in results.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        ratio = result["median"] / reference["median"]
+        if ratio > 1 + threshold:
+            regressions.append(f"{key}: {ratio:.2f}x slower")
+
+    return regressions
+
+def main() -> int:
+    """Entrypoint"""
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--filter", default="", help="run benchmarks containing this text")
+    parser.add_argument("--min-time", type=float, default=0.5, help="seconds per benchmark")
+    parser.add_argument("--max-runs", type=int, default=1000, help="runs per benchmark")
+    parser.add_argument("--save", help="save results (json)")
+    parser.add_argument("--compare", help="compare with saved results (json)")
+    parser.add_argument("--threshold", type=float, default=0.2,
+        help="slowdown ratio reported as a regression (default 0.2: 20%%)")
+    args = parser.parse_args()
+
+    results: Dict[str, dict] = {}
+    print(
+        f"{'benchmark':<28} {'runs':>6} {'min':>10} {'median':>10} {'mean':>10} "
+        f"{'peak mem':>10}"
+    )
+
+    for benchmark in benchmarks():
+        if args.filter not in benchmark.key:
+            continue
+
+        result = measure(benchmark.setup(), args.min_time, args.max_runs)
+        results[benchmark.key] = result
+
+        print(
+            f"{benchmark.key:<28} {result['runs']:>6} {human_time(result['min']):>10} "
+            f"{human_time(result['median']):>10} {human_time(result['mean']):>10} "
+            f"{result['peak_memory'] / 1024:>8.0f}KB"
+        )
+
+    if args.save:
+        Path(args.save).write_text(json.dumps(results, indent=2), encoding='UTF-8')
+
+    if args.compare:
+        baseline: Dict[str, dict] = json.loads(Path(args.compare).read_text(encoding='UTF-8'))
+        regressions = compare(results, baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
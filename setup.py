@@ -34,9 +34,10 @@ setup(
         'certbuilder', # admission certificate for kopf
         'kubernetes',
         'pydantic',
-        'requests',
+        'aiohttp',
         'hvac',
-        'pyyaml'
+        'pyyaml',
+        'prometheus_client'
     ],
     extras_require={
         "dev": [